@@ -0,0 +1,264 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pygit import base
+from pygit import data
+
+from . import repo_gen
+from . import scenarios
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Regressions smaller than this (in seconds) are noise
+MIN_DELTA = 0.001
+
+
+def main():
+    args = parse_args()
+    sys.exit(args.func(args))
+
+
+def _add_shape_arguments(parser):
+    defaults = repo_gen.Shape()
+    parser.add_argument("--files", type=int, default=defaults.files)
+    parser.add_argument("--depth", type=int, default=defaults.depth)
+    parser.add_argument("--file-size", type=int, default=defaults.file_size)
+    parser.add_argument("--commits", type=int, default=defaults.commits)
+    parser.add_argument("--branches", type=int, default=defaults.branches)
+    parser.add_argument("--changes", type=int, default=defaults.changes)
+    parser.add_argument("--loose", action="store_true")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def _shape_from_args(args):
+    return repo_gen.Shape(
+        files=args.files,
+        depth=args.depth,
+        file_size=args.file_size,
+        commits=args.commits,
+        branches=args.branches,
+        changes=args.changes,
+        packed=not args.loose,
+        seed=args.seed,
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="pygit benchmark suite"
+    )
+
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser("generate")
+    generate_parser.set_defaults(func=generate)
+    generate_parser.add_argument("path")
+    _add_shape_arguments(generate_parser)
+
+    run_parser = commands.add_parser("run")
+    run_parser.set_defaults(func=run)
+    _add_shape_arguments(run_parser)
+    run_parser.add_argument(
+        "-s", "--scenario", action="append", choices=list(scenarios.SCENARIOS)
+    )
+    run_parser.add_argument("-r", "--repeat", type=int, default=3)
+    run_parser.add_argument("-o", "--output")
+    run_parser.add_argument("--baseline")
+    run_parser.add_argument("--threshold", type=float, default=0.1)
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.set_defaults(func=compare)
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    # Runs a single scenario, in the process started by run
+    child_parser = commands.add_parser("_child")
+    child_parser.set_defaults(func=_child)
+    child_parser.add_argument("scenario")
+    child_parser.add_argument("workdir")
+    child_parser.add_argument("shape")
+
+    return parser.parse_args()
+
+
+def generate(args):
+    repo_gen.generate(args.path, _shape_from_args(args))
+    print(f"Generated repository in {args.path}")
+
+
+def _run_scenario(name, template, workdir, shape):
+    # Each run gets a fresh copy of the repository and a fresh process, so that
+    # caches are cold and the peak RSS is the one of the scenario
+    shutil.copytree(template, f"{workdir}/repo", symlinks=True)
+    try:
+        proc = subprocess.run(
+            [sys.executable, "-m", "benchmarks", "_child", name, workdir]
+            + [json.dumps(shape._asdict())],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        )
+    finally:
+        shutil.rmtree(workdir)
+    assert proc.returncode == 0, f"Scenario {name} failed:\n{proc.stderr}"
+    return json.loads(proc.stdout)
+
+
+def run(args):
+    shape = _shape_from_args(args)
+    names = args.scenario or list(scenarios.SCENARIOS)
+
+    workdir = tempfile.mkdtemp(prefix="pygit-bench-")
+    try:
+        template = f"{workdir}/template"
+        start = time.perf_counter()
+        repo_gen.generate(template, shape)
+        print(f"Generated in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+
+        results = {}
+        for name in names:
+            runs = [
+                _run_scenario(name, template, f"{workdir}/run", shape)
+                for _ in range(args.repeat)
+            ]
+            walls = [r["wall"] for r in runs]
+            results[name] = {
+                "wall": walls,
+                "min": min(walls),
+                "median": statistics.median(walls),
+                "max_rss_kb": max(r["max_rss_kb"] for r in runs),
+                "counters": runs[-1]["counters"],
+            }
+            print(
+                f"{name:>16}: {results[name]['median'] * 1000:9.1f} ms "
+                f"{results[name]['max_rss_kb']:8d} KiB",
+                file=sys.stderr,
+            )
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "shape": shape._asdict(),
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        return 1 if _compare(baseline, report, args.threshold) else 0
+    return 0
+
+
+def _compare(baseline, current, threshold):
+    # Prints both results side by side, returns the regressed scenarios
+    if baseline["shape"] != current["shape"]:
+        print("Warning: the repository shapes differ", file=sys.stderr)
+
+    regressions = []
+    print(f"{'scenario':>16} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in current["scenarios"].items():
+        old = baseline["scenarios"].get(name)
+        if not old:
+            continue
+        change = result["median"] / old["median"] - 1 if old["median"] else 0
+        rss_change = result["max_rss_kb"] / old["max_rss_kb"] - 1
+        slower = change > threshold and result["median"] - old["median"] > MIN_DELTA
+        flags = []
+        if slower:
+            flags.append("SLOWER")
+        if rss_change > threshold:
+            flags.append("MORE MEMORY")
+        if flags:
+            regressions.append(name)
+        print(
+            f"{name:>16} {old['median'] * 1000:9.1f} ms "
+            f"{result['median'] * 1000:9.1f} ms {change:+8.1%} {' '.join(flags)}"
+        )
+    return regressions
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    return 1 if _compare(baseline, current, args.threshold) else 0
+
+
+def _caches():
+    return {
+        "object_cache": data.object_cache,
+        "commit_cache": base.commit_cache,
+        "tree_cache": base.tree_cache,
+    }
+
+
+def _peak_rss_kb():
+    # ru_maxrss keeps the peak of the parent when the process was forked from
+    # it, the high water mark of /proc is the one of this process only
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _child(args):
+    shape = repo_gen.Shape(**json.loads(args.shape))
+    setup, run_scenario = scenarios.SCENARIOS[args.scenario]
+
+    os.chdir(f"{args.workdir}/repo")
+    # Scenario output would mix with the result
+    with data.change_git_dir("."), contextlib.redirect_stdout(sys.stderr):
+        setup(shape, args.workdir)
+        # Commands start with cold caches
+        for cache in _caches().values():
+            cache.clear()
+            cache.hits = cache.misses = 0
+
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        run_scenario(shape, args.workdir)
+        wall = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+
+        check = scenarios.CHECKS.get(args.scenario)
+        if check:
+            check(shape, args.workdir)
+
+    counters = {"objects_read": data.object_cache.misses}
+    for name, cache in _caches().items():
+        counters[f"{name}_hits"] = cache.hits
+        counters[f"{name}_misses"] = cache.misses
+    counters["user_time"] = after.ru_utime - before.ru_utime
+    counters["system_time"] = after.ru_stime - before.ru_stime
+    counters["block_reads"] = after.ru_inblock - before.ru_inblock
+    counters["block_writes"] = after.ru_oublock - before.ru_oublock
+
+    result = {"wall": wall, "max_rss_kb": _peak_rss_kb(), "counters": counters}
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
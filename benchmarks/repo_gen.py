@@ -0,0 +1,119 @@
+import contextlib
+import io
+import os
+import random
+
+from collections import namedtuple
+
+from pygit import base
+from pygit import data
+
+# files: number of files, spread over directories up to depth levels deep
+# file_size: average file size in bytes
+# commits: length of the history of master
+# branches: topic branches forked from master and merged back
+# changes: files edited by each commit
+Shape = namedtuple(
+    "Shape",
+    ["files", "depth", "file_size", "commits", "branches", "changes", "packed", "seed"],
+    defaults=(1000, 3, 4096, 50, 4, 20, True, 0),
+)
+
+# Branch forked from the middle of the history, checked out and merged by the
+# scenarios
+BENCH_BRANCH = "bench"
+
+# Subdirectories per directory level
+_FANOUT = 8
+_LINE_LENGTH = 64
+
+
+def _random_line(rng):
+    return f"{rng.getrandbits(_LINE_LENGTH * 4):0{_LINE_LENGTH}x}\n"
+
+
+def _random_text(rng, size):
+    lines = max(1, rng.randint(size // 2, size * 3 // 2) // (_LINE_LENGTH + 1))
+    return "".join(_random_line(rng) for _ in range(lines))
+
+
+def _write_file(path, text):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def edit_files(rng, paths, count):
+    # Replaces a few lines of count random files, returns the edited paths
+    edited = rng.sample(paths, min(count, len(paths)))
+    for path in edited:
+        with open(path) as f:
+            lines = f.readlines()
+        for _ in range(rng.randint(1, 3)):
+            lines[rng.randrange(len(lines))] = _random_line(rng)
+        _write_file(path, "".join(lines))
+    return edited
+
+
+def iter_paths(shape):
+    rng = random.Random(shape.seed)
+    for i in range(shape.files):
+        depth = rng.randint(0, shape.depth)
+        dirs = [f"d{rng.randrange(_FANOUT)}" for _ in range(depth)]
+        yield "/".join(dirs + [f"f{i}.txt"])
+
+
+def _commit_changes(rng, paths, shape, message):
+    base.add(edit_files(rng, paths, shape.changes))
+    return base.commit(message)
+
+
+def generate(path, shape):
+    # Builds a repository of the given shape in the new directory path. The
+    # same shape always gives the same objects
+    rng = random.Random(shape.seed)
+    paths = list(iter_paths(shape))
+
+    os.makedirs(path)
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        with data.change_git_dir("."), contextlib.redirect_stdout(io.StringIO()):
+            base.init()
+            for file_path in paths:
+                _write_file(file_path, _random_text(rng, shape.file_size))
+            base.add(paths)
+            history = [base.commit("initial")]
+
+            # Topic branches fork at evenly spaced commits, get a few commits of
+            # their own and are merged back after a commit on master
+            step = max(1, shape.commits // (shape.branches + 1))
+            topics = 0
+            while len(history) < shape.commits:
+                if topics < shape.branches and len(history) % step == 0:
+                    topics += 1
+                    topic = f"topic{topics}"
+                    base.create_branch(topic, history[-1])
+                    base.checkout(topic)
+                    for i in range(3):
+                        _commit_changes(rng, paths, shape, f"{topic} {i}")
+                    base.checkout("master")
+                    history.append(_commit_changes(rng, paths, shape, "master"))
+                    base.merge(base.get_oid(topic))
+                    history.append(base.commit(f"merge {topic}"))
+                else:
+                    message = f"commit {len(history)}"
+                    history.append(_commit_changes(rng, paths, shape, message))
+
+            base.create_branch(BENCH_BRANCH, history[len(history) // 2])
+            base.checkout(BENCH_BRANCH)
+            for i in range(2):
+                _commit_changes(rng, paths, shape, f"{BENCH_BRANCH} {i}")
+            base.checkout("master")
+
+            if shape.packed:
+                base.repack()
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,151 @@
+import os
+import random
+
+from pygit import base
+from pygit import data
+from pygit import diff
+from pygit import remote
+
+from . import repo_gen
+
+# Scenarios run in a copy of the generated repository, as the current
+# directory. setup(shape, workdir) prepares what the scenario needs and is not
+# timed, run(shape, workdir) is
+
+
+def _edit_tenth(shape, workdir):
+    rng = random.Random(shape.seed + 1)
+    paths = list(repo_gen.iter_paths(shape))
+    repo_gen.edit_files(rng, paths, max(1, len(paths) // 10))
+
+
+def _setup_commit(shape, workdir):
+    _edit_tenth(shape, workdir)
+    base.add(["."])
+
+
+def _add(shape, workdir):
+    base.add(["."])
+
+
+def _commit(shape, workdir):
+    base.commit("bench")
+
+
+def _status(shape, workdir):
+    HEAD = base.get_oid("@")
+    index_tree = base.get_index_tree()
+    list(base.compare_tree_oids(base.get_commit(HEAD).tree, base.as_tree(index_tree)))
+    list(diff.iter_changed_files(index_tree, base.get_working_tree()))
+
+
+def _diff(shape, workdir):
+    changes = diff.compare_trees(base.get_index_tree(), base.get_working_tree())
+    for _ in diff.diff_changes(changes, True):
+        pass
+
+
+def _log(shape, workdir):
+    for oid in base.iter_commits_and_parents({base.get_oid("@")}):
+        base.get_commit(oid)
+
+
+def _checkout(shape, workdir):
+    base.checkout(repo_gen.BENCH_BRANCH)
+
+
+def _merge(shape, workdir):
+    base.merge(base.get_oid(repo_gen.BENCH_BRANCH))
+
+
+def _merge_base(shape, workdir):
+    base.get_merge_bases(base.get_oid("@"), base.get_oid(repo_gen.BENCH_BRANCH))
+
+
+def _setup_remote(shape, workdir):
+    with data.change_git_dir(f"{workdir}/remote"):
+        os.makedirs(f"{workdir}/remote")
+        base.init()
+
+
+def _fetch(shape, workdir):
+    with data.change_git_dir(f"{workdir}/remote"):
+        remote.fetch(os.getcwd())
+
+
+def _push(shape, workdir):
+    remote.push(f"{workdir}/remote", "refs/heads/master")
+
+
+# Commits pushed on top of a remote that has the rest of the history
+INCREMENTAL_COMMITS = 3
+# Bytes of a pack and its index beyond the compressed objects: headers,
+# checksums and fan-out table, and per object its entry header and index entry
+PACK_OVERHEAD = 2048
+INDEX_ENTRY_SIZE = 64
+
+
+def _object_counts():
+    # Number and size of the objects, loose or packed
+    counts = data.count_objects()
+    return (
+        counts.loose + counts.packed,
+        counts.loose_bytes + counts.packed_bytes,
+    )
+
+
+def _setup_push_incremental(shape, workdir):
+    _setup_remote(shape, workdir)
+    _push(shape, workdir)
+    with data.change_git_dir(f"{workdir}/remote"):
+        remote_count, remote_size = _object_counts()
+
+    # The new objects are written loose
+    count, size = _object_counts()
+    rng = random.Random(shape.seed + 2)
+    paths = list(repo_gen.iter_paths(shape))
+    for i in range(INCREMENTAL_COMMITS):
+        base.add(repo_gen.edit_files(rng, paths, shape.changes))
+        base.commit(f"incremental {i}")
+    new_count, new_size = _object_counts()
+    with open(f"{workdir}/expected", "w") as f:
+        f.write(f"{remote_count} {remote_size} {new_count - count} {new_size - size}")
+
+
+def _check_push_incremental(shape, workdir):
+    # Only the objects of the new commits are sent, not the trees and blobs
+    # they share with the history: the pack is about the size of the loose
+    # new objects, plus its index
+    with open(f"{workdir}/expected") as f:
+        remote_count, remote_size, new_count, new_size = map(int, f.read().split())
+    with data.change_git_dir(f"{workdir}/remote"):
+        count, size = _object_counts()
+    sent, sent_size = count - remote_count, size - remote_size
+    assert sent <= new_count, f"Pushed {sent} objects for {new_count} new ones"
+    max_size = new_size + PACK_OVERHEAD + INDEX_ENTRY_SIZE * new_count
+    assert sent_size <= max_size, f"Pushed {sent_size} bytes for {new_size} new ones"
+
+
+def _noop(shape, workdir):
+    pass
+
+
+# name: (setup, run)
+SCENARIOS = {
+    "add": (_edit_tenth, _add),
+    "commit": (_setup_commit, _commit),
+    "status": (_edit_tenth, _status),
+    "diff": (_edit_tenth, _diff),
+    "log": (_noop, _log),
+    "checkout": (_noop, _checkout),
+    "merge": (_noop, _merge),
+    "merge-base": (_noop, _merge_base),
+    "fetch": (_setup_remote, _fetch),
+    "push": (_setup_remote, _push),
+    "push-incremental": (_setup_push_incremental, _push),
+}
+
+# name: check, run after the scenario (and not timed) to verify its result
+CHECKS = {
+    "push-incremental": _check_push_incremental,
+}
@@ -1,13 +1,28 @@
 import os
+import heapq
 import itertools
 import operator
 import string
+import time
 
+from . import commit_graph
 from . import data
 from . import diff
 
 from collections import deque, namedtuple
 
+# Parsed commits and tree entries, by oid
+commit_cache = data.LRUCache(int(os.environ.get("PYGIT_COMMIT_CACHE_SIZE", 16384)))
+tree_cache = data.LRUCache(int(os.environ.get("PYGIT_TREE_CACHE_SIZE", 4096)))
+# Generations of commits outside of the commit graph
+generation_cache = data.LRUCache(
+    int(os.environ.get("PYGIT_GENERATION_CACHE_SIZE", 16384))
+)
+
+# Unreachable objects younger than this (in seconds) are not pruned by gc, they
+# may belong to a command that is still running
+GC_GRACE_PERIOD = int(os.environ.get("PYGIT_GC_GRACE_PERIOD", 14 * 24 * 3600))
+
 
 def init():
     data.init()
@@ -15,36 +30,47 @@ def init():
 
 
 def write_tree(directory="."):
-    # Index is flat, we need it as a tree of dicts
-    index_as_tree = {}
     with data.get_index() as index:
-        for path, oid in index.items():
-            path = path.split("/")
-            dirpath, filename = path[:-1], path[-1]
-
-            current = index_as_tree
-            # Find the dict for the directory of this file
-            for dirname in dirpath:
-                current = current.setdefault(dirname, {})
-            current[filename] = oid
-
-    def write_tree_recursive(tree_dict):
-        entries = []
-        for name, value in tree_dict.items():
-            if type(value) is dict:
-                obj_type = "tree"
-                oid = write_tree_recursive(value)
-            else:
-                obj_type = "blob"
-                oid = value
-            entries.append((name, oid, obj_type))
-
-        tree = "".join(
-            f"{obj_type} {oid} {name}\n" for name, oid, obj_type in sorted(entries)
-        )
-        return data.hash_object(tree.encode(), "tree")
+        flat_tree = {path: entry.oid for path, entry in index.items()}
+    return _hash_tree(_nest_tree(flat_tree), write=True)[0]
+
+
+def as_tree(flat_tree):
+    # In-memory tree of a flat {path: oid} tree, its tree oids are computed but
+    # not written, so it can be compared with stored trees
+    return _hash_tree(_nest_tree(flat_tree), write=False)[1]
+
+
+def _nest_tree(flat_tree):
+    # Flat tree as a tree of dicts
+    nested = {}
+    for path, oid in flat_tree.items():
+        path = path.split("/")
+        dirpath, filename = path[:-1], path[-1]
+
+        current = nested
+        # Find the dict for the directory of this file
+        for dirname in dirpath:
+            current = current.setdefault(dirname, {})
+        current[filename] = oid
+    return nested
+
+
+def _hash_tree(tree_dict, write):
+    # Returns the tree oid and the tree as {name: (obj_type, oid, subtree)}
+    entries = {}
+    for name, value in tree_dict.items():
+        if type(value) is dict:
+            oid, subtree = _hash_tree(value, write)
+            entries[name] = ("tree", oid, subtree)
+        else:
+            entries[name] = ("blob", value, None)
 
-    return write_tree_recursive(index_as_tree)
+    tree = "".join(
+        f"{obj_type} {oid} {name}\n"
+        for name, (obj_type, oid, _) in sorted(entries.items())
+    )
+    return data.hash_object(tree.encode(), "tree", write=write), entries
 
 
 def is_ignored(path):
@@ -54,10 +80,55 @@ def is_ignored(path):
 def _iter_tree_entries(oid):
     if not oid:
         return
-    tree = data.get_object(oid, "tree")
-    for entry in tree.decode().splitlines():
-        obj_type, oid, name = entry.split(" ", 2)
-        yield obj_type, oid, name
+    entries = tree_cache.get(oid)
+    if entries is None:
+        tree = data.get_object(oid, "tree")
+        entries = [tuple(entry.split(" ", 2)) for entry in tree.decode().splitlines()]
+        tree_cache.put(oid, entries)
+    yield from entries
+
+
+def _get_tree_node(tree):
+    # Entries of a tree oid or of an in-memory tree (see as_tree), subtrees are
+    # referenced by oid for stored trees
+    if not tree:
+        return {}
+    if type(tree) is dict:
+        return tree
+    return {
+        name: (obj_type, oid, oid) for obj_type, oid, name in _iter_tree_entries(tree)
+    }
+
+
+def _all_equal(*oids):
+    return len(set(oids)) == 1
+
+
+def compare_tree_oids(*trees, skip=_all_equal, base_path=""):
+    # Walks the trees (tree oids or in-memory trees) together, yielding
+    # (path, *blob oids) for the blobs that differ. Subtrees whose oids are
+    # skipped (the same in all trees by default) are never read
+    nodes = [_get_tree_node(tree) for tree in trees]
+    for name in sorted(set().union(*nodes)):
+        path = base_path + name
+        entries = [node.get(name) for node in nodes]
+
+        blobs = [
+            entry[1] if entry and entry[0] == "blob" else None for entry in entries
+        ]
+        if any(blobs) and not skip(*blobs):
+            yield (path, *blobs)
+
+        subtrees = [
+            entry if entry and entry[0] == "tree" else None for entry in entries
+        ]
+        tree_oids = [entry and entry[1] for entry in subtrees]
+        if any(tree_oids) and not skip(*tree_oids):
+            yield from compare_tree_oids(
+                *(entry and entry[2] for entry in subtrees),
+                skip=skip,
+                base_path=f"{path}/",
+            )
 
 
 def get_tree(oid, base_path=""):
@@ -75,51 +146,146 @@ def get_tree(oid, base_path=""):
     return result
 
 
-def _empty_current_directory():
-    for root, dirnames, filenames in os.walk(".", topdown=False):
-        for filename in filenames:
-            path = os.path.relpath(f"{root}/{filename}")
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            os.remove(path)
-        for dirname in dirnames:
-            path = os.path.relpath(f"{root}/{dirname}")
-            if is_ignored(path):
-                continue
-            try:
-                os.rmdir(path)
-            except (FileNotFoundError, OSError):
-                # Deletion might fail if the directory contains ignored files,
-                # so it's OK
-                pass
-
-
 def read_tree(tree_oid, update_working=False):
     with data.get_index() as index:
+        old_index = dict(index)
+        if update_working:
+            _read_tree_from_HEAD(index, tree_oid)
+            _checkout_index(old_index, index)
+            return
+
         index.clear()
-        index.update(get_tree(tree_oid))
+        for path, oid in get_tree(tree_oid).items():
+            index[path] = data.index_entry(oid)
+
+
+def _read_tree_from_HEAD(index, tree_oid):
+    # Paths that are the same in HEAD and in the tree keep their index entry,
+    # staged changes included. The others are only replaced when the index
+    # still holds HEAD's version (or already the tree's)
+    HEAD = data.get_ref("HEAD").value
+    staged = []
+    for path, object_HEAD, object_tree in compare_tree_oids(
+        HEAD and _get_commit_tree(HEAD), tree_oid
+    ):
+        entry = index.get(path)
+        if (entry and entry.oid) not in (object_HEAD, object_tree):
+            staged.append(path)
+        elif object_tree:
+            index[path] = data.index_entry(object_tree)
+        else:
+            index.pop(path, None)
+    assert not staged, "Staged changes would be overwritten:\n" + "\n".join(staged)
 
-        if update_working:
-            _checkout_index(index)
+
+def _other_unchanged(object_base, object_HEAD, object_other):
+    return object_other in (object_base, object_HEAD)
 
 
 def read_tree_merged(t_base, t_HEAD, t_other, update_working=False):
+    # The index holds HEAD's version, only paths changed by the other side
+    # need to be merged into it. Returns the paths with conflicts
+    conflicts = []
     with data.get_index() as index:
-        index.clear()
-        index.update(
-            diff.merge_trees(get_tree(t_base), get_tree(t_HEAD), get_tree(t_other))
-        )
+        old_index = dict(index)
+        for path, oid, conflicted in diff.merge_changes(
+            compare_tree_oids(t_base, t_HEAD, t_other, skip=_other_unchanged)
+        ):
+            if oid:
+                index[path] = data.index_entry(oid)
+            else:
+                index.pop(path, None)
+            if conflicted:
+                conflicts.append(path)
 
         if update_working:
-            _checkout_index(index)
-
-
-def _checkout_index(index):
-    _empty_current_directory()
-    for path, oid in index.items():
-        os.makedirs(os.path.dirname(f"./{path}"), exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(data.get_object(oid, "blob"))
+            _checkout_index(old_index, index)
+    return conflicts
+
+
+def _is_dirty(path, old_entry, new_entry, deleted):
+    # Whether the file at path holds content that checking out new_entry
+    # (None to delete it) would lose. A directory in the way is only dirty
+    # when it holds anything but deleted paths
+    full_path = data.working_path(path)
+    if not os.path.lexists(full_path):
+        return False
+    if os.path.isdir(full_path) and not os.path.islink(full_path):
+        return not _holds_only(path, deleted)
+    if not os.path.isfile(full_path):
+        return True
+    st = os.stat(full_path)
+    if old_entry and old_entry == data.index_entry_from_stat(old_entry.oid, st):
+        return False
+    oid = data.hash_file(full_path, write=False)
+    return oid not in (old_entry and old_entry.oid, new_entry and new_entry.oid)
+
+
+def _holds_only(dirname, paths):
+    # Whether dirname goes away once paths are removed: empty directories are
+    # only removed along with the last of their files
+    with os.scandir(data.working_path(dirname)) as entries:
+        entries = [(f"{dirname}/{entry.name}", entry.path) for entry in entries]
+    if not entries:
+        return False
+    for path, full_path in entries:
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            if not _holds_only(path, paths):
+                return False
+        elif path not in paths:
+            return False
+    return True
+
+
+def _remove_empty_directories(dirname):
+    while dirname:
+        try:
+            os.rmdir(data.working_path(dirname))
+        except OSError:
+            # Not empty, it still holds other (maybe untracked) files
+            return
+        dirname = os.path.dirname(dirname)
+
+
+def _checkout_file(path, oid):
+    full_path = data.working_path(path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "wb") as f:
+        for chunk in data.iter_object_chunks(oid, "blob"):
+            f.write(chunk)
+    return path, data.index_entry_from_stat(oid, os.stat(full_path))
+
+
+def _checkout_index(old_index, index):
+    # Only the paths that differ between the old and the new index are
+    # touched in the working tree, the other files keep their stat data
+    deleted = [path for path in old_index if path not in index]
+    changed = []
+    for path, entry in index.items():
+        old_entry = old_index.get(path)
+        if old_entry and old_entry.oid == entry.oid:
+            index[path] = old_entry
+        else:
+            changed.append(path)
+
+    deleted_paths = set(deleted)
+    dirty = [
+        path
+        for path in deleted + changed
+        if _is_dirty(path, old_index.get(path), index.get(path), deleted_paths)
+    ]
+    assert not dirty, "Local changes would be overwritten:\n" + "\n".join(sorted(dirty))
+
+    for path in deleted:
+        if os.path.isfile(data.working_path(path)):
+            os.remove(data.working_path(path))
+        _remove_empty_directories(os.path.dirname(path))
+
+    # Files are written on a pool of threads, so big checkouts overlap I/O
+    with data.thread_pool() as executor:
+        index.update(
+            executor.map(lambda path: _checkout_file(path, index[path].oid), changed)
+        )
 
 
 def commit(message):
@@ -138,6 +304,8 @@ def commit(message):
 
     oid = data.hash_object(commit.encode(), "commit")
     data.update_ref("HEAD", data.ref_value(symbolic=False, value=oid))
+    # Goes to a new layer of the graph, the graph isn't rewritten
+    write_commit_graph({oid})
     return oid
 
 
@@ -145,6 +313,14 @@ Commit = namedtuple("Commit", ["tree", "parents", "message"])
 
 
 def get_commit(oid):
+    commit = commit_cache.get(oid)
+    if commit is None:
+        commit = _parse_commit(oid)
+        commit_cache.put(oid, commit)
+    return commit
+
+
+def _parse_commit(oid):
     parents = []
     tree = None
     commit = data.get_object(oid, "commit").decode()
@@ -162,10 +338,95 @@ def get_commit(oid):
     return Commit(tree=tree, parents=parents, message=message)
 
 
+def _get_parents(oid):
+    graph = data.get_commit_graph()
+    entry = graph and graph.get(oid)
+    if entry:
+        return entry.parents
+    return get_commit(oid).parents
+
+
+def _get_commit_tree(oid):
+    graph = data.get_commit_graph()
+    entry = graph and graph.get(oid)
+    if entry:
+        return entry.tree
+    return get_commit(oid).tree
+
+
+def get_generation(oid):
+    # Commits outside of the graph get theirs from the generations of their
+    # parents. Without a graph all generations are infinite
+    graph = data.get_commit_graph()
+    if not graph:
+        return commit_graph.GENERATION_INFINITY
+    generation = graph.generation(oid)
+    if generation != commit_graph.GENERATION_INFINITY:
+        return generation
+
+    generation = generation_cache.get(oid)
+    if generation is None:
+        commits = {}
+        _add_graph_entries(commits, [oid], graph)
+        for commit, entry in commits.items():
+            generation_cache.put(commit, entry.generation)
+        generation = commits[oid].generation
+    return generation
+
+
+def write_commit_graph(oids=None):
+    # Adds the commits reachable from oids (from all refs by default) to the
+    # commit graph, returns the number of commits added
+    if oids is None:
+        oids = {
+            ref.value
+            for _, ref in data.iter_refs()
+            if data.object_exists(ref.value)
+            and data.get_object_type(ref.value) == "commit"
+        }
+
+    commits = {}
+    _add_graph_entries(commits, oids, data.get_commit_graph())
+
+    if commits:
+        data.append_commit_graph(commits)
+    return len(commits)
+
+
+def _add_graph_entries(commits, oids, graph=None):
+    # Adds the commits reachable from oids that are neither in commits nor in
+    # graph to commits. Post order walk: generations are computed once the
+    # generations of all parents are known
+    def known(oid):
+        return oid in commits or (graph is not None and oid in graph)
+
+    def known_generation(oid):
+        return commits[oid].generation if oid in commits else graph.generation(oid)
+
+    stack = [oid for oid in oids if oid]
+    while stack:
+        oid = stack[-1]
+        if known(oid):
+            stack.pop()
+            continue
+        commit = get_commit(oid)
+        missing = [parent for parent in commit.parents if not known(parent)]
+        if missing:
+            stack.extend(missing)
+            continue
+        stack.pop()
+        generation = 1 + max(
+            (known_generation(parent) for parent in commit.parents), default=0
+        )
+        commits[oid] = commit_graph.GraphEntry(
+            tree=commit.tree, parents=commit.parents, generation=generation
+        )
+
+
 def checkout(name):
     oid = get_oid(name)
     commit = get_commit(oid)
-    read_tree(commit.tree)
+    read_tree(commit.tree, update_working=True)
 
     HEAD = None
     if is_branch(name):
@@ -191,14 +452,24 @@ def get_oid(name):
     # name is ref
     refs_to_try = [f"{name}", f"refs/{name}", f"refs/tags/{name}", f"refs/heads/{name}"]
     for ref in refs_to_try:
-        if data.get_ref(ref, deref=False).value:
-            return data.get_ref(ref).value
+        value = data.get_ref(ref, deref=False)
+        if value.value:
+            return data.get_ref(ref).value if value.symbolic else value.value
 
     # name is SHA1
     is_hex = all(c in string.hexdigits for c in name)
     if len(name) == 40 and is_hex:
         return name
 
+    # name is an abbreviated SHA1
+    if data.MIN_ABBREV_LENGTH <= len(name) < 40 and is_hex:
+        oids = data.find_oids(name)
+        assert len(oids) < 2, f"Ambiguous name {name}: " + ", ".join(
+            data.abbreviate_oid(oid) for oid in oids
+        )
+        if oids:
+            return oids[0]
+
     assert False, f"Unknown name {name}"
 
 
@@ -214,34 +485,139 @@ def iter_commits_and_parents(oids):
         visited.add(oid)
         yield oid
 
-        commit = get_commit(oid)
+        parents = _get_parents(oid)
         # Return first parent next
-        oids.extendleft(commit.parents[:1])
+        oids.extendleft(parents[:1])
         # Return other parents later
-        oids.extend(commit.parents[1:])
+        oids.extend(parents[1:])
 
 
 def iter_objects_in_commits(oids):
     # N.B. Must yield the oid before acccessing it (to allow caller to fetch it
     # if needed)
     visited = set()
-
-    def iter_objects_in_tree(oid):
-        visited.add(oid)
-        yield oid
-        for obj_type, oid, _ in _iter_tree_entries(oid):
-            if oid not in visited:
-                if obj_type == "tree":
-                    yield from iter_objects_in_tree(oid)
-                else:
-                    visited.add(oid)
-                    yield oid
-
     for oid in iter_commits_and_parents(oids):
         yield oid
-        commit = get_commit(oid)
-        if commit.tree not in visited:
-            yield from iter_objects_in_tree(commit.tree)
+        tree = _get_commit_tree(oid)
+        if tree not in visited:
+            yield from _iter_objects_in_tree(tree, visited)
+
+
+def _iter_objects_in_tree(oid, visited):
+    # Objects of the tree that aren't in visited, added to it as they are
+    # yielded
+    visited.add(oid)
+    yield oid
+    for obj_type, oid, _ in _iter_tree_entries(oid):
+        if oid not in visited:
+            if obj_type == "tree":
+                yield from _iter_objects_in_tree(oid, visited)
+            else:
+                visited.add(oid)
+                yield oid
+
+
+def _iter_new_commits(oids, known_oids, flags):
+    # Commits reachable from oids but not from known_oids, highest generation
+    # first. Walked commits are painted in flags, True for the ones reachable
+    # from known_oids: the walk doesn't go below them and stops once only
+    # known commits are left. A commit may be painted as known after having
+    # been yielded.
+    # N.B. Must yield the oid before acccessing it (to allow caller to fetch it
+    # if needed)
+    queue = []
+    counter = itertools.count()
+
+    def paint(oid, is_known):
+        flags[oid] = is_known
+        heapq.heappush(queue, (-get_generation(oid), next(counter), oid))
+
+    for oid in known_oids:
+        if oid and oid not in flags and data.object_exists(oid):
+            paint(oid, True)
+    for oid in oids:
+        if oid and oid not in flags:
+            paint(oid, False)
+
+    yielded = set()
+    while not all(flags[oid] for _, _, oid in queue):
+        _, _, oid = heapq.heappop(queue)
+        is_known = flags[oid]
+        if not is_known and oid not in yielded:
+            yielded.add(oid)
+            yield oid
+        for parent in _get_parents(oid):
+            if parent not in flags or is_known and not flags[parent]:
+                paint(parent, is_known)
+
+
+def _iter_new_tree_objects(tree, known_trees, visited):
+    # Objects of tree that are neither in visited nor at the same path in one
+    # of known_trees (trees whose objects are known or were yielded already),
+    # subtrees found in known_trees are not walked
+    visited.add(tree)
+    yield tree, "tree"
+    known_nodes = [_get_tree_node(known_tree) for known_tree in known_trees]
+    for obj_type, oid, name in _iter_tree_entries(tree):
+        if oid in visited:
+            continue
+        known_entries = [node[name] for node in known_nodes if name in node]
+        if any(known_oid == oid for _, known_oid, _ in known_entries):
+            continue
+        if obj_type == "tree":
+            known_subtrees = [
+                known_oid
+                for known_type, known_oid, _ in known_entries
+                if known_type == "tree"
+            ]
+            yield from _iter_new_tree_objects(oid, known_subtrees, visited)
+        else:
+            visited.add(oid)
+            yield oid, obj_type
+
+
+def iter_new_objects(oids, known_oids):
+    # Objects reachable from oids but not from known_oids, as (oid, obj_type).
+    # The trees of new commits are compared to the trees of all their
+    # parents, and only the differences are walked: the objects of known
+    # parents exist, the ones of new parents were yielded before
+    # N.B. Must yield the oid before acccessing it (to allow caller to fetch it
+    # if needed)
+    flags = {}
+    commits = []
+    for oid in _iter_new_commits(oids, known_oids, flags):
+        yield oid, "commit"
+        commits.append(oid)
+
+    visited = set()
+    for oid in _parents_first(commits):
+        tree = _get_commit_tree(oid)
+        parent_trees = [_get_commit_tree(parent) for parent in _get_parents(oid)]
+        if flags[oid] or tree in visited or tree in parent_trees:
+            continue
+        yield from _iter_new_tree_objects(tree, parent_trees, visited)
+
+
+def _parents_first(commits):
+    # commits ordered so that the ones among them that are parents of others
+    # come first
+    pending = set(commits)
+    order = []
+    for oid in commits:
+        stack = [oid]
+        while stack:
+            oid = stack[-1]
+            if oid not in pending:
+                stack.pop()
+                continue
+            parents = [parent for parent in _get_parents(oid) if parent in pending]
+            if parents:
+                stack.extend(parents)
+                continue
+            stack.pop()
+            pending.remove(oid)
+            order.append(oid)
+    return order
 
 
 def create_branch(name, oid):
@@ -266,21 +642,95 @@ def reset(oid):
     data.update_ref("HEAD", data.ref_value(symbolic=False, value=oid))
 
 
+def _get_entry_names(oids):
+    # Entry names are used as delta base hints
+    names = {}
+    for oid in oids:
+        if data.get_object_type(oid) == "tree":
+            for _, entry_oid, name in _iter_tree_entries(oid):
+                names.setdefault(entry_oid, name)
+    return names
+
+
+def repack():
+    oids = list(data.iter_loose_objects())
+    if not oids:
+        return None
+
+    name = data.pack_objects(oids, _get_entry_names(oids))
+    for oid in oids:
+        data.delete_loose_object(oid)
+    return name
+
+
+def gc(grace_period=GC_GRACE_PERIOD):
+    # Packs the objects reachable from the refs and the index into a single
+    # pack, then deletes the other packs and the loose objects. Unreachable
+    # objects younger than grace_period (in seconds) are kept. Returns the
+    # object counts before and after
+    before = data.count_objects()
+    expire = time.time() - grace_period
+
+    # Refs may point to trees and blobs as well, only commits have history
+    roots = {ref.value for _, ref in data.iter_refs() if ref.value}
+    root_types = {oid: data.get_object_type(oid) for oid in roots}
+    commits = {oid for oid in roots if root_types[oid] == "commit"}
+    reachable = list(iter_objects_in_commits(commits))
+    visited = set(reachable)
+    for oid in roots - commits:
+        if oid in visited:
+            continue
+        if root_types[oid] == "tree":
+            reachable.extend(_iter_objects_in_tree(oid, visited))
+        else:
+            visited.add(oid)
+            reachable.append(oid)
+    with data.get_index() as index:
+        reachable.extend({entry.oid for entry in index.values()} - visited)
+
+    name = None
+    if reachable:
+        name = data.pack_objects(reachable, _get_entry_names(reachable))
+    packed = set(reachable)
+    data.prune_packs(name, packed, expire)
+    data.prune_loose_objects(packed, expire)
+
+    # Drops the commits that were pruned from the commit graph
+    graph_entries = {}
+    _add_graph_entries(graph_entries, commits)
+    data.write_commit_graph(graph_entries)
+
+    return before, data.count_objects()
+
+
 def get_working_tree():
     result = {}
-    for root, _, filenames in os.walk("."):
-        for filename in filenames:
-            path = os.path.relpath(f"{root}/{filename}")
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            with open(path, "rb") as f:
-                result[path] = data.hash_object(f.read())
+    working_dir = data.current_repository().path
+    with data.get_index() as index:
+        for root, _, filenames in os.walk(working_dir):
+            for filename in filenames:
+                full_path = f"{root}/{filename}"
+                path = os.path.relpath(full_path, working_dir)
+                if is_ignored(path) or not os.path.isfile(full_path):
+                    continue
+
+                # Files whose stat data matches the index are unchanged
+                st = os.stat(full_path)
+                entry = index.get(path)
+                if entry and entry == data.index_entry_from_stat(entry.oid, st):
+                    result[path] = entry.oid
+                    continue
+
+                result[path] = data.hash_file(full_path, write=False)
+                if entry and entry.oid == result[path]:
+                    # Refresh the stat data so the file isn't hashed again
+                    index[path] = data.index_entry_from_stat(entry.oid, st)
     return result
 
 
 def get_index_tree():
     with data.get_index() as index:
-        return index
+        return {path: entry.oid for path, entry in index.items()}
 
 
 def merge(other):
@@ -291,52 +741,147 @@ def merge(other):
 
     # Handle fast-forward merge
     if merge_base == HEAD:
-        read_tree(c_other.tree)
+        read_tree(c_other.tree, update_working=True)
         data.update_ref("HEAD", data.ref_value(symbolic=False, value=other))
         print("Fast-forward merge, no need to commit")
         return
 
-    data.update_ref("MERGE_HEAD", data.ref_value(symbolic=False, value=other))
-
     c_base = get_commit(merge_base)
     c_HEAD = get_commit(HEAD)
 
-    read_tree_merged(c_base.tree, c_HEAD.tree, c_other.tree)
-    print("Merged in working tree\nPlease commit")
+    conflicts = read_tree_merged(
+        c_base.tree, c_HEAD.tree, c_other.tree, update_working=True
+    )
+    data.update_ref("MERGE_HEAD", data.ref_value(symbolic=False, value=other))
+    for path in conflicts:
+        print(f"Conflict in {path}")
+    if conflicts:
+        print("Merged in working tree with conflicts\nFix them, then commit")
+    else:
+        print("Merged in working tree\nPlease commit")
 
 
 def get_merge_base(oid1, oid2):
-    parents = set(iter_commits_and_parents({oid1}))
-
-    for oid in iter_commits_and_parents({oid2}):
-        if oid in parents:
-            return oid
+    merge_bases = get_merge_bases(oid1, oid2)
+    return merge_bases[0] if merge_bases else None
+
+
+def get_merge_bases(oid1, *others):
+    # All best common ancestors of oid1 and any of others, highest generation
+    # first
+    candidates = _paint_down_to_common(oid1, others)
+    if len(candidates) > 1:
+        candidates = [
+            oid
+            for oid in candidates
+            if not any(
+                other != oid and is_ancestor_of(other, oid) for other in candidates
+            )
+        ]
+    return candidates
+
+
+_PARENT1, _PARENT2, _STALE, _RESULT = 1, 2, 4, 8
+
+
+def _paint_down_to_common(oid1, others):
+    # Commits are walked from the highest generation down, painted with the
+    # sides they are reachable from. A commit reachable from both sides is a
+    # candidate and everything below it is stale, the walk stops once only
+    # stale commits are left to visit. Without a graph all generations are
+    # infinite, commits are walked in the order they are found
+    flags = {}
+    queue = []
+    counter = itertools.count()
+
+    def paint(oid, flag):
+        flags[oid] = flags.get(oid, 0) | flag
+        heapq.heappush(queue, (-get_generation(oid), next(counter), oid))
+
+    paint(oid1, _PARENT1)
+    for oid in others:
+        paint(oid, _PARENT2)
+
+    results = []
+    while any(not flags[oid] & _STALE for _, _, oid in queue):
+        _, _, oid = heapq.heappop(queue)
+        flag = flags[oid] & (_PARENT1 | _PARENT2 | _STALE)
+        if flag == _PARENT1 | _PARENT2:
+            if not flags[oid] & _RESULT:
+                flags[oid] |= _RESULT
+                results.append(oid)
+            flag |= _STALE
+        for parent in _get_parents(oid):
+            if flags.get(parent, 0) & flag != flag:
+                paint(parent, flag)
+
+    # Candidates found before a better one made them stale are dropped
+    return [oid for oid in results if not flags[oid] & _STALE]
 
 
 def is_ancestor_of(commit, maybe_ancestor):
-    return maybe_ancestor in iter_commits_and_parents({commit})
+    # Generations strictly decrease along parents: commits with a lower
+    # generation than maybe_ancestor can't reach it and are not walked. Without
+    # a graph nothing is pruned
+    min_generation = get_generation(maybe_ancestor)
+    if min_generation == commit_graph.GENERATION_INFINITY:
+        min_generation = 0
+
+    oids = [commit]
+    visited = set()
+    while oids:
+        oid = oids.pop()
+        if oid == maybe_ancestor:
+            return True
+        if oid in visited:
+            continue
+        visited.add(oid)
+        oids.extend(
+            parent
+            for parent in _get_parents(oid)
+            if get_generation(parent) >= min_generation
+        )
+    return False
+
+
+def _iter_files(dirname):
+    working_dir = data.current_repository().path
+    for root, _, filenames in os.walk(data.working_path(dirname)):
+        for filename in filenames:
+            full_path = f"{root}/{filename}"
+            # Normalize path
+            path = os.path.relpath(full_path, working_dir)
+            if is_ignored(path) or not os.path.isfile(full_path):
+                continue
+            yield path
 
 
 def add(filenames):
-    def add_file(filename):
-        # Normalize path
-        filename = os.path.relpath(filename)
-        with open(filename, "rb") as f:
-            oid = data.hash_object(f.read())
-            index[filename] = oid
-
-    def add_directory(dirname):
-        for root, _, filenames in os.walk(dirname):
-            for filename in filenames:
-                # Normalize path
-                path = os.path.relpath(f"{root}/{filename}")
-                if is_ignored(path) or not os.path.isfile(path):
-                    continue
-                add_file(filename)
+    # filenames are relative to the root of the working tree
+    working_dir = data.current_repository().path
+    paths = []
+    for name in filenames:
+        path = os.path.relpath(data.working_path(name), working_dir)
+        if os.path.isfile(data.working_path(path)):
+            paths.append(path)
+        elif os.path.isdir(data.working_path(path)):
+            paths.extend(_iter_files(path))
 
     with data.get_index() as index:
-        for name in filenames:
-            if os.path.isfile(name):
-                add_file(name)
-            elif os.path.isdir(name):
-                add_directory(name)
+        known = {path: index.get(path) for path in paths}
+
+        def add_file(path):
+            # Files whose stat data matches the index are stored already
+            full_path = data.working_path(path)
+            st = os.stat(full_path)
+            entry = known[path]
+            if entry and entry == data.index_entry_from_stat(entry.oid, st):
+                return path, entry
+            oid = data.hash_file(full_path)
+            return path, data.index_entry_from_stat(oid, st)
+
+        # Hashing and compression release the GIL, files are streamed on a
+        # pool of threads and the index is updated once at the end
+        with data.thread_pool() as executor:
+            entries = dict(executor.map(add_file, known))
+        index.update(entries)
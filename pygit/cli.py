@@ -1,26 +1,55 @@
 import argparse
+import contextlib
+import io
 import os
+import shlex
+import socket
 import sys
 import textwrap
 import subprocess
 
 from . import base
+from . import daemon
 from . import data
 from . import diff
+from . import protocol
 from . import remote
+from . import trace
 
 
 def main():
-    with data.change_git_dir("."):
+    with data.use_repository(data.open_repository(".")):
+        trace.enable(os.environ.get(trace.ENV_VAR))
         args = parse_args()
-        args.func(args)
+        trace.enable(args.trace)
+        try:
+            trace.traced(f"command {args.command}", args.func)(args)
+        finally:
+            remote.close_connections()
+            data.close_repositories()
+            trace.report()
 
 
-def parse_args():
+# Built once, batch parses every command with it
+_parser = None
+
+
+def parse_args(argv=None):
+    global _parser
+    if _parser is None:
+        _parser = _build_parser()
+    return _parser.parse_args(argv)
+
+
+def _build_parser():
     parser = argparse.ArgumentParser(
         prog="pygit", description="version control system cli"
     )
 
+    # Summary table on stderr, or Chrome trace file
+    parser.add_argument("--trace", action="store_const", const="-")
+    parser.add_argument("--trace-file", dest="trace", metavar="PATH.json")
+
     commands = parser.add_subparsers(dest="command", required=True)
 
     oid = base.get_oid
@@ -34,7 +63,10 @@ def parse_args():
 
     cat_file_parser = commands.add_parser("cat-file")
     cat_file_parser.set_defaults(func=cat_file)
-    cat_file_parser.add_argument("object", type=oid)
+    cat_file_mode = cat_file_parser.add_mutually_exclusive_group(required=True)
+    cat_file_mode.add_argument("--batch", action="store_true")
+    cat_file_mode.add_argument("--batch-check", action="store_true")
+    cat_file_mode.add_argument("object", type=oid, nargs="?")
 
     write_tree_parser = commands.add_parser("write-tree")
     write_tree_parser.set_defaults(func=write_tree)
@@ -49,6 +81,7 @@ def parse_args():
 
     log_parser = commands.add_parser("log")
     log_parser.set_defaults(func=log)
+    log_parser.add_argument("--abbrev-commit", action="store_true")
     log_parser.add_argument("oid", default="@", type=oid, nargs="?")
 
     checkout_parser = commands.add_parser("checkout")
@@ -90,11 +123,13 @@ def parse_args():
 
     merge_base_parser = commands.add_parser("merge-base")
     merge_base_parser.set_defaults(func=merge_base)
+    merge_base_parser.add_argument("--all", action="store_true")
     merge_base_parser.add_argument("commit1", type=oid)
     merge_base_parser.add_argument("commit2", type=oid)
 
     fetch_parser = commands.add_parser("fetch")
     fetch_parser.set_defaults(func=fetch)
+    fetch_parser.add_argument("-j", "--jobs", type=int, default=remote.TRANSFER_WORKERS)
     fetch_parser.add_argument("remote")
 
     push_parser = commands.add_parser("push")
@@ -102,27 +137,100 @@ def parse_args():
     push_parser.add_argument("remote")
     push_parser.add_argument("branch")
 
+    daemon_parser = commands.add_parser("daemon")
+    daemon_parser.set_defaults(func=_daemon)
+    daemon_parser.add_argument("url", default=protocol.DEFAULT_URL, nargs="?")
+
+    repack_parser = commands.add_parser("repack")
+    repack_parser.set_defaults(func=repack)
+
+    gc_parser = commands.add_parser("gc")
+    gc_parser.set_defaults(func=gc)
+    gc_parser.add_argument("--grace-period", type=int, default=base.GC_GRACE_PERIOD)
+
+    pack_refs_parser = commands.add_parser("pack-refs")
+    pack_refs_parser.set_defaults(func=pack_refs)
+
+    commit_graph_parser = commands.add_parser("commit-graph")
+    commit_graph_parser.set_defaults(func=commit_graph)
+
+    migrate_objects_parser = commands.add_parser("migrate-objects")
+    migrate_objects_parser.set_defaults(func=migrate_objects)
+
     add_parser = commands.add_parser("add")
     add_parser.set_defaults(func=add)
     add_parser.add_argument("files", nargs="+")
 
-    return parser.parse_args()
+    batch_parser = commands.add_parser("batch")
+    batch_parser.set_defaults(func=batch)
+
+    return parser
 
 
 def add(args):
     base.add(args.files)
 
 
+def _daemon(args):
+    def ready(server):
+        url = args.url
+        if protocol.parse_url(url)[0] != socket.AF_UNIX:
+            host, port = server.server_address[:2]
+            url = f"{protocol.TCP_PREFIX}{host}:{port}"
+        print(f"Serving on {url}", flush=True)
+
+    try:
+        daemon.serve(args.url, ready)
+    except KeyboardInterrupt:
+        pass
+
+
+def repack(args):
+    name = base.repack()
+    if name:
+        print(f"pack-{name}")
+
+
+def gc(args):
+    before, after = base.gc(args.grace_period)
+    for title, counts in (("Before", before), ("After", after)):
+        objects = counts.loose + counts.packed
+        size = counts.loose_bytes + counts.packed_bytes
+        print(
+            f"{title}: {objects} objects, {size} bytes "
+            f"({counts.loose} loose, {counts.packed} packed)"
+        )
+    reclaimed = before.loose_bytes + before.packed_bytes
+    reclaimed -= after.loose_bytes + after.packed_bytes
+    print(f"Reclaimed {reclaimed} bytes")
+
+
+def pack_refs(args):
+    print(f"Packed {data.pack_refs()} refs")
+
+
+def commit_graph(args):
+    print(f"Added {base.write_commit_graph()} commits to the commit graph")
+
+
+def migrate_objects(args):
+    print(f"Migrated {data.migrate_loose_objects()} objects")
+
+
 def push(args):
     remote.push(args.remote, f"refs/heads/{args.branch}")
 
 
 def fetch(args):
-    remote.fetch(args.remote)
+    remote.fetch(args.remote, args.jobs)
 
 
 def merge_base(args):
-    print(base.get_merge_base(args.commit1, args.commit2))
+    if args.all:
+        for oid in base.get_merge_bases(args.commit1, args.commit2):
+            print(oid)
+    else:
+        print(base.get_merge_base(args.commit1, args.commit2))
 
 
 def merge(args):
@@ -131,27 +239,27 @@ def merge(args):
 
 def _diff(args):
     oid = args.commit and base.get_oid(args.commit)
-    tree_from = None
-    tree_to = None
+    working_tree = not args.cached
+    tree_to = base.get_index_tree() if args.cached else base.get_working_tree()
+
     if args.commit:
         # If a commit was provided explicitly, diff from it
-        tree_from = base.get_tree(oid and base.get_commit(oid).tree)
-
-    if args.cached:
-        tree_to = base.get_index_tree()
-        if not args.commit:
-            # If no commit was provided, diff from HEAD
-            oid = base.get_oid("@")
-            tree_from = base.get_tree(oid and base.get_commit(oid).tree)
+        changes = base.compare_tree_oids(
+            base.get_commit(oid).tree, base.as_tree(tree_to)
+        )
+    elif args.cached:
+        # If no commit was provided, diff from HEAD
+        oid = base.get_oid("@")
+        changes = base.compare_tree_oids(
+            oid and base.get_commit(oid).tree, base.as_tree(tree_to)
+        )
     else:
-        tree_to = base.get_working_tree()
-        if not args.commit:
-            # If no commit was provided, diff from index
-            tree_from = base.get_index_tree()
+        # If no commit was provided, diff from index
+        changes = diff.compare_trees(base.get_index_tree(), tree_to)
 
-    result = diff.diff_trees(tree_from, tree_to)
     sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    for chunk in diff.diff_changes(changes, working_tree):
+        sys.stdout.buffer.write(chunk)
 
 
 def show(args):
@@ -164,9 +272,9 @@ def show(args):
         parent_tree = base.get_commit(commit.parents[0]).tree
 
     _print_commits(args.oid, commit)
-    result = diff.diff_trees(base.get_tree(parent_tree), base.get_tree(commit.tree))
     sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    for chunk in diff.diff_changes(base.compare_tree_oids(parent_tree, commit.tree)):
+        sys.stdout.buffer.write(chunk)
 
 
 def _print_commits(oid, commit, refs=None):
@@ -186,23 +294,22 @@ def status(args):
     if branch:
         print(f"On branch {branch}")
     else:
-        print(f"HEAD detached at {HEAD[:10]}")
+        print(f"HEAD detached at {data.abbreviate_oid(HEAD)}")
 
     MERGE_HEAD = data.get_ref("MERGE_HEAD").value
     if MERGE_HEAD:
-        print(f"Merging with {MERGE_HEAD[:10]}")
+        print(f"Merging with {data.abbreviate_oid(MERGE_HEAD)}")
 
     print("\nChanges to be committed:\n")
     HEAD_tree = HEAD and base.get_commit(HEAD).tree
-    for path, action in diff.iter_changed_files(
-        base.get_tree(HEAD_tree), base.get_index_tree()
+    index_tree = base.get_index_tree()
+    for path, action in diff.iter_change_actions(
+        base.compare_tree_oids(HEAD_tree, base.as_tree(index_tree))
     ):
         print(f"{action:>12}: {path}")
 
     print("\nChanges not staged to commit:\n")
-    for path, action in diff.iter_changed_files(
-        base.get_index_tree(), base.get_working_tree()
-    ):
+    for path, action in diff.iter_changed_files(index_tree, base.get_working_tree()):
         print(f"{action:>12}: {path}")
 
 
@@ -214,7 +321,8 @@ def branch(args):
             print(f"{prefix} {branch}")
     else:
         base.create_branch(args.name, args.start_point)
-        print(f"Branch {args.name} created at {args.start_point[:10]}")
+        start_point = data.abbreviate_oid(args.start_point)
+        print(f"Branch {args.name} created at {start_point}")
 
 
 def k(args):
@@ -230,7 +338,7 @@ def k(args):
 
     for oid in base.iter_commits_and_parents(oids):
         commit = base.get_commit(oid)
-        dot += f'"{oid}" [shape=box style=filled label="{oid[:10]}"]\n'
+        dot += f'"{oid}" [shape=box style=filled label="{data.abbreviate_oid(oid)}"]\n'
         for parent in commit.parents:
             dot += f'"{oid}" -> "{parent}"\n'
 
@@ -259,7 +367,8 @@ def log(args):
     for oid in base.iter_commits_and_parents({args.oid}):
         commit = base.get_commit(oid)
 
-        _print_commits(oid, commit, refs.get(oid))
+        name = data.abbreviate_oid(oid) if args.abbrev_commit else oid
+        _print_commits(name, commit, refs.get(oid))
 
 
 def commit(args):
@@ -275,15 +384,83 @@ def write_tree(args):
 
 
 def cat_file(args):
+    if args.batch or args.batch_check:
+        _cat_file_batch(with_content=args.batch)
+        return
     sys.stdout.flush()
-    sys.stdout.buffer.write(data.get_object(args.object, expected=None))
+    for chunk in data.iter_object_chunks(args.object, expected=None):
+        sys.stdout.buffer.write(chunk)
+
+
+def _cat_file_batch(with_content):
+    # One object name per line of stdin, answered with "<oid> <type> <size>"
+    # and the content (followed by a newline) with --batch, "<name> missing"
+    # for names that don't resolve to an object
+    out = sys.stdout.buffer
+    for line in iter(sys.stdin.readline, ""):
+        name = line.strip()
+        try:
+            oid = base.get_oid(name)
+        except AssertionError:
+            oid = None
+        if not oid or not data.object_exists(oid):
+            out.write(f"{name} missing\n".encode())
+        elif with_content:
+            obj_type, size, chunks = data.stream_object(oid)
+            out.write(f"{oid} {obj_type} {size}\n".encode())
+            for chunk in chunks:
+                out.write(chunk)
+            out.write(b"\n")
+        else:
+            obj_type, size = data.get_object_header(oid)
+            out.write(f"{oid} {obj_type} {size}\n".encode())
+        out.flush()
+
+
+def batch(args):
+    # Runs the commands read from stdin, one per line, in this process: the
+    # parser, the repository state and the caches are kept across commands.
+    # Each response is a "<status> <length>" line followed by length bytes of
+    # output, status is "ok" or "error" (the output is the error message then)
+    out = sys.stdout.buffer
+    for line in iter(sys.stdin.readline, ""):
+        if not line.strip():
+            continue
+        status, output = _run_batch_command(line)
+        out.write(f"{status} {len(output)}\n".encode() + output)
+        out.flush()
+
+
+def _run_batch_command(line):
+    output = io.BytesIO()
+    stdout = io.TextIOWrapper(output, write_through=True)
+    stderr = io.StringIO()
+    # Repositories may have been changed by other processes since the last
+    # command
+    data.invalidate_repositories()
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            args = parse_args(shlex.split(line))
+            # These would read the commands that follow as their own input
+            assert args.func is not batch, "batch can't be nested"
+            assert not (
+                args.func is cat_file and (args.batch or args.batch_check)
+            ), "cat-file --batch reads stdin, use cat-file <object>"
+            trace.traced(f"command {args.command}", args.func)(args)
+    except SystemExit as e:
+        # Raised by argparse, for usage errors and --help
+        if e.code:
+            return "error", stderr.getvalue().encode()
+    except Exception as e:
+        return "error", f"{type(e).__name__}: {e}".encode()
+    return "ok", output.getvalue()
 
 
 def hash_object(args):
-    with open(args.file, "rb") as f:
-        print(data.hash_object(f.read()))
+    print(data.hash_file(args.file))
 
 
 def init(args):
     base.init()
-    print(f"Initialized empty Pygit repository in {os.getcwd()}/{data.GIT_DIR}/")
+    git_dir = data.current_repository().git_dir
+    print(f"Initialized empty Pygit repository in {git_dir}/")
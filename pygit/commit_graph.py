@@ -0,0 +1,202 @@
+import os
+import hashlib
+import mmap
+import struct
+
+from collections import namedtuple
+
+SIGNATURE = b"CGPH"
+VERSION = 1
+
+# Parent positions: NO_PARENT for a missing parent, EXTRA_EDGES flags an index
+# into the extra edges list (commits with more than two parents), where
+# LAST_EDGE flags the last parent
+NO_PARENT = 0xFFFFFFFF
+EXTRA_EDGES = 0x80000000
+LAST_EDGE = 0x80000000
+
+# Generation of commits that are not in the graph
+GENERATION_INFINITY = 0xFFFFFFFF
+
+# Fixed width entry: tree, first parent, second parent, generation
+_entry_struct = struct.Struct(">20sIII")
+
+GraphEntry = namedtuple("GraphEntry", ["tree", "parents", "generation"])
+
+
+def write(commits, path):
+    # commits: {oid: GraphEntry}, the parents of every commit must be in it
+    _write_file(_serialize(commits), path)
+
+
+def write_layer(commits, directory, base):
+    # Writes commits as a layer on top of base, the parents of every commit
+    # must be in it or in base. Returns the file name of the layer
+    graph = _serialize(commits, base)
+    name = f"graph-{graph[-20:].hex()}.graph"
+    _write_file(graph, f"{directory}/{name}")
+    return name
+
+
+def _serialize(commits, base=None):
+    # Positions of a layer count the commits of its base first
+    oids = sorted(commits)
+    base_count = len(base) if base is not None else 0
+    positions = {oid: base_count + i for i, oid in enumerate(oids)}
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[int(oid[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    graph = bytearray(SIGNATURE + struct.pack(">II", VERSION, len(oids)))
+    graph += struct.pack(">256I", *fanout)
+    for oid in oids:
+        graph += bytes.fromhex(oid)
+
+    extra_edges = []
+    for oid in oids:
+        tree, parents, generation = commits[oid]
+        parents = [
+            positions[parent] if parent in positions else base.find(parent)
+            for parent in parents
+        ]
+        first = parents[0] if parents else NO_PARENT
+        if len(parents) <= 2:
+            second = parents[1] if len(parents) == 2 else NO_PARENT
+        else:
+            second = EXTRA_EDGES | len(extra_edges)
+            extra_edges += parents[1:-1]
+            extra_edges.append(LAST_EDGE | parents[-1])
+        graph += _entry_struct.pack(bytes.fromhex(tree), first, second, generation)
+
+    graph += struct.pack(f">{len(extra_edges)}I", *extra_edges)
+    graph += hashlib.sha1(graph).digest()
+    return graph
+
+
+def _write_file(graph, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(graph)
+    os.replace(tmp_path, path)
+
+
+class CommitGraph:
+    FANOUT_OFFSET = 12
+    OIDS_OFFSET = FANOUT_OFFSET + 256 * 4
+
+    def __init__(self, path, base=None):
+        self.path = path
+        # Graph this one is a layer on top of
+        self.base = base
+        self.base_count = len(base) if base is not None else 0
+        with open(path, "rb") as f:
+            self.graph = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self.graph[:4] == SIGNATURE, f"Bad commit graph {path}"
+        self.count = struct.unpack_from(">I", self.graph, 8)[0]
+        self.fanout = struct.unpack_from(">256I", self.graph, self.FANOUT_OFFSET)
+        self.entries_offset = self.OIDS_OFFSET + 20 * self.count
+        self.edges_offset = self.entries_offset + _entry_struct.size * self.count
+
+    def _oid_at(self, position):
+        if position < self.base_count:
+            return self.base._oid_at(position)
+        start = self.OIDS_OFFSET + 20 * (position - self.base_count)
+        return self.graph[start : start + 20]
+
+    def find(self, oid):
+        # Returns the position of the commit in the graph, those of the base
+        # come first
+        i = self._find_in_layer(bytes.fromhex(oid))
+        if i is not None:
+            return self.base_count + i
+        if self.base is not None:
+            return self.base.find(oid)
+        return None
+
+    def _find_in_layer(self, raw):
+        # Binary search the sorted oids within the fanout bucket of the first
+        # byte
+        lo = self.fanout[raw[0] - 1] if raw[0] else 0
+        hi = self.fanout[raw[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.OIDS_OFFSET + 20 * mid
+            current = self.graph[start : start + 20]
+            if current == raw:
+                return mid
+            if current < raw:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _parent_positions(self, first, second):
+        if first == NO_PARENT:
+            return
+        yield first
+        if second == NO_PARENT:
+            return
+        if not second & EXTRA_EDGES:
+            yield second
+            return
+        offset = self.edges_offset + 4 * (second & ~EXTRA_EDGES)
+        while True:
+            edge = struct.unpack_from(">I", self.graph, offset)[0]
+            yield edge & ~LAST_EDGE
+            if edge & LAST_EDGE:
+                return
+            offset += 4
+
+    def _entry_at(self, position):
+        if position < self.base_count:
+            return self.base._entry_at(position)
+        tree, first, second, generation = _entry_struct.unpack_from(
+            self.graph,
+            self.entries_offset + _entry_struct.size * (position - self.base_count),
+        )
+        parents = [
+            self._oid_at(position).hex()
+            for position in self._parent_positions(first, second)
+        ]
+        return GraphEntry(tree=tree.hex(), parents=parents, generation=generation)
+
+    def get(self, oid):
+        position = self.find(oid)
+        if position is None:
+            return None
+        return self._entry_at(position)
+
+    def generation(self, oid):
+        i = self._find_in_layer(bytes.fromhex(oid))
+        if i is None:
+            if self.base is not None:
+                return self.base.generation(oid)
+            return GENERATION_INFINITY
+        offset = self.entries_offset + _entry_struct.size * i + 28
+        return struct.unpack_from(">I", self.graph, offset)[0]
+
+    def __contains__(self, oid):
+        return self.find(oid) is not None
+
+    def __len__(self):
+        return self.base_count + self.count
+
+    def items(self):
+        if self.base is not None:
+            yield from self.base.items()
+        yield from self.layer_items()
+
+    def layer_items(self):
+        # Commits of this layer only
+        for position in range(self.base_count, len(self)):
+            yield self._oid_at(position).hex(), self._entry_at(position)
+
+    def checksum(self):
+        return self.graph[-20:].hex()
+
+    def close(self):
+        self.graph.close()
+        if self.base is not None:
+            self.base.close()
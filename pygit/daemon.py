@@ -0,0 +1,145 @@
+import os
+import socket
+import socketserver
+import threading
+
+from . import base
+from . import data
+from . import protocol
+
+# Commit graph and ref updates of pushes are applied one push at a time
+_push_lock = threading.Lock()
+
+# Clients can only push branches
+PUSH_REFS_BASE = "refs/heads/"
+_OID_DIGITS = set("0123456789abcdef")
+
+
+def _check_oid(oid):
+    assert len(oid) == 40 and set(oid) <= _OID_DIGITS, f"Invalid object name {oid}"
+
+
+def _check_refname(refname):
+    # Refs are files under the git dir, names coming from clients must not
+    # point anywhere else
+    components = refname.split("/")
+    assert (
+        refname.startswith(PUSH_REFS_BASE)
+        and "" not in components
+        and not {".", ".."} & set(components)
+    ), f"Invalid ref name {refname}"
+
+
+def _ls_refs(handler, args, lines):
+    prefix = args[0] if args else ""
+    refs = [f"{ref.value} {refname}" for refname, ref in data.iter_refs(prefix)]
+    protocol.write_status(handler.wfile, lines=refs)
+
+
+def _fetch(handler, args, lines):
+    wants = [line.split(" ", 1)[1] for line in lines if line.startswith("want ")]
+    haves = [line.split(" ", 1)[1] for line in lines if line.startswith("have ")]
+    for oid in wants + haves:
+        _check_oid(oid)
+    for oid in wants:
+        assert data.object_exists(oid), f"Unknown object {oid}"
+
+    # Objects are listed before anything is sent, errors can still be reported
+    oids = [oid for oid, _ in base.iter_new_objects(wants, haves)]
+    protocol.write_status(handler.wfile)
+    data.write_pack_stream(oids, protocol.PacketWriter(handler.wfile))
+    protocol.write_flush(handler.wfile)
+
+
+def _push(handler, args, lines):
+    # The pack is read even when the push is refused so that the connection
+    # stays in sync, it is only stored for valid requests
+    chunks = protocol.iter_packets(handler.rfile)
+    try:
+        assert len(args) == 3, "Expect a ref name, its old and new values"
+        refname, old, new = args
+        _check_refname(refname)
+        _check_oid(old)
+        _check_oid(new)
+    except AssertionError:
+        for _ in chunks:
+            pass
+        raise
+    data.receive_pack(chunks)
+
+    with _push_lock:
+        current = data.get_ref(refname).value or protocol.ZERO_OID
+        assert current == old, f"{refname} changed, fetch first"
+        assert data.object_exists(new), f"Missing object {new}"
+        assert current == protocol.ZERO_OID or base.is_ancestor_of(
+            new, current
+        ), "Not a fast-forward"
+
+        base.write_commit_graph({new})
+        data.update_ref(refname, data.ref_value(symbolic=False, value=new))
+    protocol.write_status(handler.wfile)
+
+
+COMMANDS = {
+    "ls-refs": _ls_refs,
+    "fetch": _fetch,
+    "push": _push,
+}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        with data.use_repository(self.server.repository):
+            self._serve()
+
+    def _serve(self):
+        # A connection serves commands until the client closes it
+        while True:
+            try:
+                lines = protocol.read_lines(self.rfile)
+            except EOFError:
+                return
+            if not lines:
+                continue
+
+            command, *args = lines[0].split(" ")
+            # Refs may have been changed by other processes since the last
+            # command
+            data.invalidate_refs()
+            try:
+                assert command in COMMANDS, f"Unknown command {command}"
+                COMMANDS[command](self, args, lines[1:])
+            except AssertionError as e:
+                protocol.write_status(self.wfile, error=str(e))
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(url, repo=None):
+    # Server for repo (the current repository by default), clients are served
+    # on their own thread
+    family, address = protocol.parse_url(url)
+    if family == socket.AF_UNIX:
+        # A socket file left behind by a daemon that is gone would fail bind()
+        if os.path.exists(address):
+            os.remove(address)
+        server = _UnixServer(address, _Handler)
+    else:
+        server = _TCPServer(address, _Handler)
+    server.repository = repo or data.current_repository()
+    return server
+
+
+def serve(url, ready=None, repo=None):
+    # ready is called with the server once it listens
+    with make_server(url, repo) as server:
+        if ready:
+            ready(server)
+        server.serve_forever()
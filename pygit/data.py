@@ -1,55 +1,803 @@
 import os
 import hashlib
+import itertools
 import shutil
 import json
+import string
+import struct
+import threading
+import zlib
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from contextvars import ContextVar
 
-GIT_DIR = ""
+from . import commit_graph
+from . import pack
+
+# Default length of abbreviated oids, longer when needed to be unique, and the
+# shortest prefix accepted as an object name
+ABBREV_LENGTH = 7
+MIN_ABBREV_LENGTH = 4
+
+
+class LRUCache:
+    # Least recently used cache bounded by the total size of its values,
+    # sizeof defaults to counting entries. Values bigger than max_value_size
+    # are not cached at all
+    def __init__(self, max_size, sizeof=None, max_value_size=None):
+        self.max_size = max_size
+        self.max_value_size = max_value_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self.sizeof(self._entries.pop(key))
+            if size > min(self.max_size, self.max_value_size or self.max_size):
+                return
+            self._entries[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Objects are content addressed, so cached entries never go stale. Big blobs
+# would flush most of the cache and are rarely read twice, they are skipped
+OBJECT_CACHE_SIZE = int(os.environ.get("PYGIT_OBJECT_CACHE_SIZE", 64 * 1024 * 1024))
+object_cache = LRUCache(
+    OBJECT_CACHE_SIZE,
+    sizeof=lambda obj: len(obj[1]),
+    max_value_size=OBJECT_CACHE_SIZE // 16,
+)
+
+
+def _git_dir_of(path):
+    return os.path.abspath(f"{path}/.pygit")
+
+
+_NOT_LOADED = object()
+
+
+class Repository:
+    # An open repository: its git directory and the state loaded from it.
+    # Objects, commits and trees are content addressed, their caches are shared
+    # by all repositories
+    def __init__(self, path="."):
+        # Absolute, so that the repository stays the same when the current
+        # directory changes
+        self.path = os.path.abspath(path)
+        self.git_dir = _git_dir_of(path)
+        self.lock = threading.Lock()
+        # Opened packs, and the modification time of the pack directory when
+        # they were listed
+        self.packs = None
+        self.pack_dir_mtime = None
+        # Loose objects in the flat layout, and the modification time of the
+        # objects directory when they were listed
+        self.flat_objects = None
+        self.objects_dir_mtime = None
+        # Opened commit graph, None when there is no graph
+        self.commit_graph = _NOT_LOADED
+        # Ref snapshot: {refname: value} with the loose refs read over the
+        # packed ones. Refs written by this process update the snapshot
+        self.refs = None
+
+    def close(self):
+        with self.lock:
+            for p in self.packs or []:
+                p.close()
+            self.packs = None
+            self.flat_objects = None
+            if self.commit_graph not in (None, _NOT_LOADED):
+                self.commit_graph.close()
+            self.commit_graph = _NOT_LOADED
+            self.refs = None
+
+
+# Opened repositories, by absolute git directory, they keep their state warm
+# across commands
+_repositories = {}
+_repositories_lock = threading.Lock()
+
+# Repository the functions of this module work on, each thread has its own
+_current_repository = ContextVar("current_repository", default=None)
+
+
+def open_repository(path="."):
+    key = _git_dir_of(path)
+    with _repositories_lock:
+        if key not in _repositories:
+            _repositories[key] = Repository(path)
+        return _repositories[key]
+
+
+def close_repositories():
+    with _repositories_lock:
+        for repo in _repositories.values():
+            repo.close()
+        _repositories.clear()
+
+
+def current_repository():
+    return _current_repository.get() or open_repository(".")
 
 
 @contextmanager
+def use_repository(repo):
+    token = _current_repository.set(repo)
+    try:
+        yield repo
+    finally:
+        _current_repository.reset(token)
+
+
 def change_git_dir(new_dir):
-    global GIT_DIR
-    old_dir = GIT_DIR
-    if new_dir == ".":
-        GIT_DIR = ".pygit"
-    else:
-        GIT_DIR = f"{new_dir}/.pygit"
-    yield
-    GIT_DIR = old_dir
+    return use_repository(open_repository(new_dir))
+
+
+def _git_dir():
+    return current_repository().git_dir
+
+
+def working_path(path):
+    # Path of a file of the working tree, from its path relative to the root
+    return os.path.join(current_repository().path, path)
+
+
+def thread_pool(max_workers=None):
+    # Thread pool whose workers work on the current repository
+    return ThreadPoolExecutor(
+        max_workers,
+        initializer=_current_repository.set,
+        initargs=(current_repository(),),
+    )
 
 
 def init():
-    os.makedirs(GIT_DIR)
-    os.makedirs(f"{GIT_DIR}/objects")
+    os.makedirs(_git_dir())
+    os.makedirs(f"{_git_dir()}/objects")
 
 
-# Write binary data into file name that generated using sha-1 & return object id
-def hash_object(data, obj_type="blob"):
+# Write binary data into file name that generated using sha-1 & return object id,
+# with write=False the object id is only computed
+def hash_object(data, obj_type="blob", write=True):
     obj = obj_type.encode() + b"\x00" + data
     oid = hashlib.sha1(obj).hexdigest()
-    with open(f"{GIT_DIR}/objects/{oid}", "wb") as out:
-        out.write(obj)
+    if write:
+        _write_loose_object(oid, obj)
     return oid
 
 
-def get_object(oid, expected="blob"):
-    with open(f"{GIT_DIR}/objects/{oid}", "rb") as f:
-        obj = f.read()
+def _loose_path(oid):
+    return f"{_git_dir()}/objects/{oid[:2]}/{oid[2:]}"
+
+
+# Objects written before the fan-out layout live directly in objects/
+def _flat_loose_path(oid):
+    return f"{_git_dir()}/objects/{oid}"
+
+
+def _tmp_object_path():
+    # Unique per process and thread, objects are written concurrently
+    return f"{_git_dir()}/objects/tmp_obj_{os.getpid()}_{threading.get_ident()}"
+
+
+def _store_loose_object(oid, tmp_path):
+    path = _loose_path(oid)
+    if os.path.isfile(path):
+        os.remove(tmp_path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.replace(tmp_path, path)
+    except FileNotFoundError:
+        # The fan-out directory was emptied and removed meanwhile
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+
+def _write_loose_object(oid, obj):
+    if os.path.isfile(_loose_path(oid)):
+        return
+    tmp_path = _tmp_object_path()
+    with open(tmp_path, "wb") as out:
+        out.write(zlib.compress(obj))
+    _store_loose_object(oid, tmp_path)
+
+
+# hash_object for the content of a binary stream, read (and compressed) in
+# chunks so that big files are never held in memory
+def hash_stream(stream, obj_type="blob", write=True):
+    header = obj_type.encode() + b"\x00"
+    sha = hashlib.sha1(header)
+    chunks = iter(lambda: stream.read(pack.CHUNK_SIZE), b"")
+    if not write:
+        for chunk in chunks:
+            sha.update(chunk)
+        return sha.hexdigest()
+
+    tmp_path = _tmp_object_path()
+    compressor = zlib.compressobj()
+    with open(tmp_path, "wb") as out:
+        out.write(compressor.compress(header))
+        for chunk in chunks:
+            sha.update(chunk)
+            out.write(compressor.compress(chunk))
+        out.write(compressor.flush())
+
+    oid = sha.hexdigest()
+    _store_loose_object(oid, tmp_path)
+    return oid
+
 
+def hash_file(path, obj_type="blob", write=True):
+    with open(path, "rb") as f:
+        return hash_stream(f, obj_type, write)
+
+
+def _read_loose_object(oid):
+    path = _loose_path(oid)
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            return zlib.decompress(f.read())
+
+    with open(_flat_loose_path(oid), "rb") as f:
+        return f.read()
+
+
+def _get_packs(rescan=False, repo=None):
+    # Rescans only list the pack directory when it was modified since the
+    # last scan
+    repo = repo or current_repository()
+    pack_dir = f"{repo.git_dir}/objects/pack"
+    if rescan or repo.packs is None:
+        mtime = os.stat(pack_dir).st_mtime_ns if os.path.isdir(pack_dir) else None
+        with repo.lock:
+            if repo.packs is None or repo.pack_dir_mtime != mtime:
+                known = {p.idx_path: p for p in repo.packs or []}
+                repo.packs = [
+                    known.get(path) or pack.Pack(path)
+                    for path in pack.iter_index_paths(pack_dir)
+                ]
+                repo.pack_dir_mtime = mtime
+    return repo.packs
+
+
+def get_commit_graph():
+    repo = current_repository()
+    if repo.commit_graph is _NOT_LOADED:
+        graph = None
+        path = f"{repo.git_dir}/commit-graph"
+        if os.path.exists(path):
+            graph = commit_graph.CommitGraph(path)
+        base_checksum, names = _read_commit_graph_chain(repo)
+        if base_checksum != (graph.checksum() if graph is not None else "none"):
+            # Written on top of a graph that was replaced since
+            names = []
+        for name in names:
+            try:
+                graph = commit_graph.CommitGraph(
+                    f"{repo.git_dir}/commit-graphs/{name}", graph
+                )
+            except FileNotFoundError:
+                # Merged by another process since the chain was read, the
+                # layers below are still valid on their own
+                break
+        repo.commit_graph = graph
+    return repo.commit_graph
+
+
+def _read_commit_graph_chain(repo):
+    # The checksum of the commit-graph file ("none" without one) and the names
+    # of the layers written on top of it, bottom first
+    try:
+        with open(f"{repo.git_dir}/commit-graphs/commit-graph-chain") as f:
+            base_checksum, *names = f.read().split()
+            return base_checksum, names
+    except FileNotFoundError:
+        return None, []
+
+
+def _write_commit_graph_chain(repo, base_checksum, names):
+    layers_dir = f"{repo.git_dir}/commit-graphs"
+    path = f"{layers_dir}/commit-graph-chain"
+    if not names:
+        if os.path.exists(path):
+            os.remove(path)
+    else:
+        with open(f"{path}.tmp", "w") as f:
+            f.write("".join(f"{line}\n" for line in [base_checksum] + names))
+        os.replace(f"{path}.tmp", path)
+
+    # Layers that left the chain
+    if os.path.isdir(layers_dir):
+        for name in set(os.listdir(layers_dir)) - set(names):
+            if name.endswith(".graph"):
+                os.remove(f"{layers_dir}/{name}")
+
+
+def write_commit_graph(commits):
+    # Replaces the commit graph with commits, in a single file
+    repo = current_repository()
+    with repo.lock:
+        _write_full_commit_graph(repo, commits)
+
+
+def _write_full_commit_graph(repo, commits):
+    # The chain goes first, the old layers don't apply to the new file
+    _write_commit_graph_chain(repo, None, [])
+    commit_graph.write(commits, f"{repo.git_dir}/commit-graph")
+    # Not closed: other threads may still be reading the old graph
+    repo.commit_graph = _NOT_LOADED
+
+
+def append_commit_graph(commits):
+    # Adds commits, whose parents are in the graph or in commits, to the graph
+    # as a new layer. A layer merges with the ones below it while it holds
+    # more than half as many commits, so that the chain stays logarithmic and
+    # a commit is rewritten a logarithmic number of times
+    repo = current_repository()
+    with repo.lock:
+        graph = get_commit_graph()
+        # Another thread may have added some of them meanwhile
+        commits = {
+            oid: entry
+            for oid, entry in commits.items()
+            if graph is None or oid not in graph
+        }
+        while graph is not None and 2 * len(commits) > graph.count:
+            commits.update(graph.layer_items())
+            graph = graph.base
+        if graph is None:
+            _write_full_commit_graph(repo, commits)
+            return
+
+        names = []
+        layer = graph
+        while layer is not None and layer.path != f"{repo.git_dir}/commit-graph":
+            names.append(os.path.basename(layer.path))
+            layer = layer.base
+        names.reverse()
+
+        layers_dir = f"{repo.git_dir}/commit-graphs"
+        os.makedirs(layers_dir, exist_ok=True)
+        names.append(commit_graph.write_layer(commits, layers_dir, graph))
+        base_checksum = layer.checksum() if layer is not None else "none"
+        _write_commit_graph_chain(repo, base_checksum, names)
+        repo.commit_graph = _NOT_LOADED
+
+
+def _read_packed_object(oid):
+    for p in _get_packs():
+        result = p.read(oid)
+        if result:
+            return result
+    return None
+
+
+def _read_object(oid):
+    cached = object_cache.get(oid)
+    if cached:
+        return cached
+    result = _read_object_uncached(oid)
+    object_cache.put(oid, result)
+    return result
+
+
+def _read_object_uncached(oid):
+    # Packs are searched first, loose objects are the fallback
+    result = _read_packed_object(oid)
+    if result:
+        return result
+
+    if not _loose_object_exists(oid):
+        # The object might have been packed since the packs were loaded
+        _get_packs(rescan=True)
+        result = _read_packed_object(oid)
+        if result:
+            return result
+
+    obj = _read_loose_object(oid)
     obj_type, _, content = obj.partition(b"\x00")
-    obj_type = obj_type.decode()
+    return obj_type.decode(), content
+
+
+def get_object(oid, expected="blob"):
+    obj_type, content = _read_object(oid)
 
     if expected is not None:
         assert obj_type == expected, f"Expect {expected}, got {obj_type}"
     return content
 
 
+def _iter_file_chunks(path):
+    with open(path, "rb") as f:
+        yield from iter(lambda: f.read(pack.CHUNK_SIZE), b"")
+
+
+def _stream_loose_object(oid):
+    path = _loose_path(oid)
+    if os.path.isfile(path):
+        chunks = pack.iter_inflate(_iter_file_chunks(path))
+    else:
+        chunks = _iter_file_chunks(_flat_loose_path(oid))
+
+    # Split the type header off the first chunks
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if b"\x00" in head:
+            break
+    obj_type, _, content = head.partition(b"\x00")
+    return obj_type.decode(), itertools.chain([content], chunks)
+
+
+def _stream_object(oid):
+    cached = object_cache.get(oid)
+    if cached:
+        return cached[0], iter([cached[1]])
+
+    for p in _get_packs():
+        result = p.stream(oid)
+        if result:
+            return result
+    if not _loose_object_exists(oid):
+        for p in _get_packs(rescan=True):
+            result = p.stream(oid)
+            if result:
+                return result
+    return _stream_loose_object(oid)
+
+
+# get_object as an iterator over chunks of the content, big objects are never
+# held in memory as a whole
+def iter_object_chunks(oid, expected="blob"):
+    obj_type, chunks = _stream_object(oid)
+
+    if expected is not None:
+        assert obj_type == expected, f"Expect {expected}, got {obj_type}"
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+
+
+def get_object_type(oid):
+    return _read_object(oid)[0]
+
+
+def _read_packed_header(oid):
+    for rescan in (False, True):
+        for p in _get_packs(rescan):
+            result = p.header(oid)
+            if result:
+                return result
+        if rescan or _loose_object_exists(oid):
+            return None
+
+
+def get_object_header(oid):
+    # Type and size of an object. Packs store both in the entry header and
+    # flat loose objects are stored as is, compressed loose objects don't
+    # store their size and are inflated a chunk at a time
+    cached = object_cache.get(oid)
+    if cached:
+        return cached[0], len(cached[1])
+
+    result = _read_packed_header(oid)
+    if result:
+        return result
+
+    path = _flat_loose_path(oid)
+    if not os.path.isfile(_loose_path(oid)) and os.path.isfile(path):
+        with open(path, "rb") as f:
+            head = f.read(32)
+        obj_type, _, _ = head.partition(b"\x00")
+        return obj_type.decode(), os.path.getsize(path) - len(obj_type) - 1
+
+    obj_type, chunks = _stream_loose_object(oid)
+    return obj_type, sum(len(chunk) for chunk in chunks)
+
+
+def stream_object(oid):
+    # Type, size and an iterator over the content of an object, which is
+    # inflated once. Compressed loose objects are read as a whole, their size
+    # is only known once inflated
+    cached = object_cache.get(oid)
+    if cached:
+        return cached[0], len(cached[1]), iter([cached[1]])
+
+    header = _read_packed_header(oid)
+    if header:
+        obj_type, chunks = _stream_object(oid)
+        return obj_type, header[1], chunks
+
+    obj_type, content = _read_object(oid)
+    return obj_type, len(content), iter([content])
+
+
+def _is_hex(name, length):
+    return len(name) == length and all(c in string.hexdigits for c in name)
+
+
+def iter_loose_objects():
+    objects_dir = f"{_git_dir()}/objects"
+    for name in os.listdir(objects_dir):
+        if _is_hex(name, 40):
+            yield name
+        elif _is_hex(name, 2):
+            for filename in os.listdir(f"{objects_dir}/{name}"):
+                if _is_hex(filename, 38):
+                    yield name + filename
+
+
+def _iter_loose_prefix(prefix):
+    objects_dir = f"{_git_dir()}/objects"
+    fanout_dir = f"{objects_dir}/{prefix[:2]}"
+    if os.path.isdir(fanout_dir):
+        for filename in os.listdir(fanout_dir):
+            if _is_hex(filename, 38) and filename.startswith(prefix[2:]):
+                yield prefix[:2] + filename
+    for name in _get_flat_objects():
+        if name.startswith(prefix):
+            yield name
+
+
+def _get_flat_objects():
+    # objects/ is only listed again when it changed, not for each prefix
+    # looked up (see migrate_loose_objects for the flat layout)
+    repo = current_repository()
+    objects_dir = f"{repo.git_dir}/objects"
+    mtime = os.stat(objects_dir).st_mtime_ns
+    with repo.lock:
+        if repo.flat_objects is None or repo.objects_dir_mtime != mtime:
+            repo.flat_objects = [
+                name for name in os.listdir(objects_dir) if _is_hex(name, 40)
+            ]
+            repo.objects_dir_mtime = mtime
+    return repo.flat_objects
+
+
+def find_oids(prefix):
+    # All objects whose oid starts with the hex prefix (at least 2 characters)
+    prefix = prefix.lower()
+    oids = set(_iter_loose_prefix(prefix))
+    for p in _get_packs():
+        oids.update(p.iter_prefix(prefix))
+    return sorted(oids)
+
+
+def abbreviate_oid(oid, min_length=ABBREV_LENGTH):
+    # Shortest prefix of oid, at least min_length long, that no other object
+    # shares
+    for length in range(min_length, len(oid)):
+        if find_oids(oid[:length]) in ([], [oid]):
+            return oid[:length]
+    return oid
+
+
+def _loose_object_exists(oid):
+    return os.path.isfile(_loose_path(oid)) or os.path.isfile(_flat_loose_path(oid))
+
+
+def delete_loose_object(oid):
+    for path in (_loose_path(oid), _flat_loose_path(oid)):
+        if os.path.isfile(path):
+            os.remove(path)
+    # The fan-out directory goes with its last object
+    try:
+        os.rmdir(os.path.dirname(_loose_path(oid)))
+    except OSError:
+        pass
+
+
+def migrate_loose_objects():
+    count = 0
+    for name in os.listdir(f"{_git_dir()}/objects"):
+        if not _is_hex(name, 40):
+            continue
+        with open(_flat_loose_path(name), "rb") as f:
+            _write_loose_object(name, f.read())
+        os.remove(_flat_loose_path(name))
+        count += 1
+    return count
+
+
+# Objects and bytes in the object store, loose and packed
+object_counts = namedtuple(
+    "object_counts", ["loose", "loose_bytes", "packed", "packed_bytes"]
+)
+
+
+def count_objects():
+    loose = loose_bytes = 0
+    for oid in iter_loose_objects():
+        loose += 1
+        loose_bytes += os.path.getsize(_existing_loose_path(oid))
+    packed = packed_bytes = 0
+    for p in _get_packs(rescan=True):
+        packed += p.count
+        packed_bytes += os.path.getsize(p.pack_path) + os.path.getsize(p.idx_path)
+    return object_counts(loose, loose_bytes, packed, packed_bytes)
+
+
+def _existing_loose_path(oid):
+    path = _loose_path(oid)
+    return path if os.path.isfile(path) else _flat_loose_path(oid)
+
+
+def prune_loose_objects(packed, expire):
+    # Deletes the loose objects in packed and the other ones last modified
+    # before expire (a timestamp), younger objects may belong to a command
+    # that is still running. Returns the number of objects pruned
+    count = 0
+    for oid in list(iter_loose_objects()):
+        if oid not in packed:
+            if os.path.getmtime(_existing_loose_path(oid)) >= expire:
+                continue
+            count += 1
+        delete_loose_object(oid)
+    return count
+
+
+def prune_packs(keep, packed, expire):
+    # Deletes the packs other than the one named keep. The objects of packs
+    # written after expire that are not in packed are kept as loose objects
+    # with the time of the pack, to be pruned once they are old enough
+    repo = current_repository()
+    for p in list(_get_packs(rescan=True)):
+        if os.path.basename(p.idx_path) == f"pack-{keep}.idx":
+            continue
+        mtime = os.path.getmtime(p.pack_path)
+        if mtime >= expire:
+            for oid in p:
+                if oid in packed or _loose_object_exists(oid):
+                    continue
+                obj_type, content = p.read(oid)
+                _write_loose_object(oid, obj_type.encode() + b"\x00" + content)
+                os.utime(_loose_path(oid), (mtime, mtime))
+
+        with repo.lock:
+            repo.packs.remove(p)
+        # Not closed: other threads may still be reading from the pack, its
+        # files are unmapped once it is no longer referenced
+        os.remove(p.idx_path)
+        os.remove(p.pack_path)
+    _get_packs(rescan=True)
+
+
+def _iter_pack_entries(oids, names=None):
+    # Only the headers are read here, contents are read by _read_pack_content
+    # while the pack is written
+    names = names or {}
+    for oid in oids:
+        obj_type, size = get_object_header(oid)
+        yield oid, obj_type, size, names.get(oid)
+
+
+def _read_pack_content(oid):
+    # Not cached: packing reads every object once
+    return _read_object_uncached(oid)[1]
+
+
+def pack_objects(oids, names=None):
+    objects = _iter_pack_entries(oids, names)
+    name = pack.write_pack(objects, _read_pack_content, f"{_git_dir()}/objects/pack")
+    _get_packs(rescan=True)
+    return name
+
+
+def write_pack_stream(oids, out):
+    # Writes the objects as a pack to the binary file object out
+    pack.write_pack_stream(_iter_pack_entries(oids), _read_pack_content, out)
+
+
+def receive_pack(chunks):
+    # Stores a pack received as chunks of bytes, returns its name (None when it
+    # holds no objects)
+    name = pack.receive_pack(chunks, f"{_git_dir()}/objects/pack")
+    _get_packs(rescan=True)
+    return name
+
+
 ref_value = namedtuple("ref_value", ["symbolic", "value"])
 
 
+def _read_packed_refs():
+    refs = {}
+    path = f"{_git_dir()}/packed-refs"
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                value, refname = line.rstrip("\n").split(" ", 1)
+                refs[refname] = value
+    return refs
+
+
+def _write_packed_refs(refs):
+    path = f"{_git_dir()}/packed-refs"
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write("# pack-refs with: sorted\n")
+        for refname in sorted(refs):
+            f.write(f"{refs[refname]} {refname}\n")
+    os.replace(tmp_path, path)
+
+
+def _iter_loose_refs():
+    yield "HEAD"
+    yield "MERGE_HEAD"
+    for root, _, filenames in os.walk(f"{_git_dir()}/refs/"):
+        root = os.path.relpath(root, _git_dir())
+        for filename in filenames:
+            yield f"{root}/{filename}"
+
+
+def _get_ref_snapshot():
+    repo = current_repository()
+    if repo.refs is None:
+        repo.refs = _read_refs()
+    return repo.refs
+
+
+def _read_refs():
+    # Loose refs take precedence over packed ones
+    refs = _read_packed_refs()
+    for refname in _iter_loose_refs():
+        ref_path = f"{_git_dir()}/{refname}"
+        if os.path.isfile(ref_path):
+            with open(ref_path) as f:
+                value = f.read().strip()
+            if value:
+                refs[refname] = value
+    return refs
+
+
+def invalidate_refs():
+    current_repository().refs = None
+
+
+def invalidate_repositories():
+    # Other processes may have changed any open repository: refs and commit
+    # graphs are read again, pack directories are listed again
+    with _repositories_lock:
+        repos = list(_repositories.values())
+    for repo in repos:
+        repo.refs = None
+        # Not closed: other threads may still be reading the old graph
+        repo.commit_graph = _NOT_LOADED
+        if repo.packs is not None:
+            _get_packs(rescan=True, repo=repo)
+
+
 def update_ref(ref, value, deref=True):
     ref = _get_ref_internal(ref, deref)[0]
 
@@ -59,10 +807,11 @@ def update_ref(ref, value, deref=True):
     else:
         value = value.value
 
-    ref_path = f"{GIT_DIR}/{ref}"
+    ref_path = f"{_git_dir()}/{ref}"
     os.makedirs(os.path.dirname(ref_path), exist_ok=True)
     with open(ref_path, "w") as f:
         f.write(value)
+    _get_ref_snapshot()[ref] = value
 
 
 def get_ref(ref, deref=True):
@@ -71,15 +820,17 @@ def get_ref(ref, deref=True):
 
 def delete_ref(ref, deref=True):
     ref = _get_ref_internal(ref, deref)[0]
-    os.remove(f"{GIT_DIR}/{ref}")
+    ref_path = f"{_git_dir()}/{ref}"
+    if os.path.isfile(ref_path):
+        os.remove(ref_path)
+    packed_refs = _read_packed_refs()
+    if packed_refs.pop(ref, None):
+        _write_packed_refs(packed_refs)
+    _get_ref_snapshot().pop(ref, None)
 
 
 def _get_ref_internal(ref, deref):
-    ref_path = f"{GIT_DIR}/{ref}"
-    value = None
-    if os.path.isfile(ref_path):
-        with open(ref_path) as f:
-            value = f.read().strip()
+    value = _get_ref_snapshot().get(ref)
 
     symbolic = bool(value) and value.startswith("ref: ")
     if symbolic:
@@ -91,12 +842,12 @@ def _get_ref_internal(ref, deref):
 
 
 def iter_refs(prefix="", deref=True):
-    refs = ["HEAD", "MERGE_HEAD"]
-    for root, _, filenames in os.walk(f"{GIT_DIR}/refs/"):
-        root = os.path.relpath(root, GIT_DIR)
-        refs.extend(f"{root}/{filename}" for filename in filenames)
+    refs = _get_ref_snapshot()
+    refnames = ["HEAD", "MERGE_HEAD"]
+    # The snapshot is copied, a daemon thread may update it meanwhile
+    refnames.extend(sorted(name for name in list(refs) if name.startswith("refs/")))
 
-    for refname in refs:
+    for refname in refnames:
         if not refname.startswith(prefix):
             continue
         ref = get_ref(refname, deref=deref)
@@ -104,30 +855,225 @@ def iter_refs(prefix="", deref=True):
             yield refname, ref
 
 
+def pack_refs():
+    # Moves all direct refs under refs/ into packed-refs, returns their number
+    refs = {
+        refname: value
+        for refname, value in _get_ref_snapshot().items()
+        if refname.startswith("refs/") and not value.startswith("ref: ")
+    }
+    _write_packed_refs(refs)
+    for refname in refs:
+        ref_path = f"{_git_dir()}/{refname}"
+        if os.path.isfile(ref_path):
+            os.remove(ref_path)
+    return len(refs)
+
+
 def object_exists(oid):
-    return os.path.isfile(f"{GIT_DIR}/objects/{oid}")
+    if any(oid in p for p in _get_packs()):
+        return True
+    if _loose_object_exists(oid):
+        return True
+    # The object might have been packed since the packs were loaded
+    return any(oid in p for p in _get_packs(rescan=True))
+
 
+def _read_remote_object(remote, oid):
+    # The remote may have been repacked since its packs were loaded
+    for p in _get_packs(rescan=True, repo=remote):
+        result = p.read(oid)
+        if result:
+            obj_type, content = result
+            return obj_type.encode() + b"\x00" + content
+    with open(f"{remote.git_dir}/objects/{oid}", "rb") as f:
+        return f.read()
 
+
+# Returns the number of bytes stored. The remote repository is read through
+# its path without making it current, so objects can be fetched from several
+# threads at once
 def fetch_object_if_missing(oid, remote_git_dir):
     if object_exists(oid):
-        return
-    remote_git_dir += "/.pygit"
-    shutil.copy(f"{remote_git_dir}/objects/{oid}", f"{GIT_DIR}/objects/{oid}")
+        return 0
+    remote = open_repository(remote_git_dir)
+    remote_path = f"{remote.git_dir}/objects/{oid[:2]}/{oid[2:]}"
+    tmp_path = _tmp_object_path()
+    if os.path.isfile(remote_path):
+        shutil.copyfile(remote_path, tmp_path)
+    else:
+        # The object is packed or in the old layout on the remote side
+        obj = _read_remote_object(remote, oid)
+        with open(tmp_path, "wb") as out:
+            out.write(zlib.compress(obj))
+    size = os.path.getsize(tmp_path)
+    _store_loose_object(oid, tmp_path)
+    return size
+
+
+def push_objects(oids, remote_git_dir):
+    # The objects are written as a single pack into the remote repository,
+    # returns the name of the pack (None when there is nothing to push)
+    objects = list(_iter_pack_entries(oids))
+    if not objects:
+        return None
+    remote = open_repository(remote_git_dir)
+    name = pack.write_pack(
+        objects, _read_pack_content, f"{remote.git_dir}/objects/pack"
+    )
+    _get_packs(rescan=True, repo=remote)
+    return name
+
 
+# Stat data lets unchanged files be detected without reading them, entries
+# created from a tree have no stat data and never match
+index_entry = namedtuple(
+    "index_entry", ["oid", "mtime", "ctime", "size", "ino", "mode"], defaults=(0,) * 5
+)
 
-def push_object(oid, remote_git_dir):
-    remote_git_dir += "/.pygit"
-    shutil.copy(f"{GIT_DIR}/objects/{oid}", f"{remote_git_dir}/objects/{oid}")
+
+def index_entry_from_stat(oid, st):
+    return index_entry(
+        oid, st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino, st.st_mode
+    )
+
+
+def _smudge_racy_entries(index, index_mtime):
+    # A file modified in the same timestamp tick as the index write could
+    # still change without its stat data changing, force a rehash next time
+    for path, entry in index.items():
+        if entry.size and entry.mtime >= index_mtime:
+            index[path] = entry._replace(size=0)
+
+
+INDEX_SIGNATURE = b"DIRC"
+INDEX_VERSION = 1
+_index_entry_struct = struct.Struct(">QQQQI20s")
+
+
+def _encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _decode_varint(buf, pos):
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+# Binary index: header, entries sorted by path and a trailing sha-1. Each entry
+# is its fixed width stat data & oid followed by its path, stored as the number
+# of bytes to strip from the previous path and the NUL terminated new suffix
+def _parse_index(raw):
+    assert raw[-20:] == hashlib.sha1(raw[:-20]).digest(), "Corrupt index"
+    signature, version, count = struct.unpack_from(">4sII", raw)
+    assert signature == INDEX_SIGNATURE, "Bad index signature"
+    assert version == INDEX_VERSION, f"Unsupported index version {version}"
+
+    index = {}
+    pos = 12
+    path = b""
+    for _ in range(count):
+        mtime, ctime, size, ino, mode, oid = _index_entry_struct.unpack_from(raw, pos)
+        pos += _index_entry_struct.size
+        strip, pos = _decode_varint(raw, pos)
+        end = raw.index(b"\x00", pos)
+        path = path[: len(path) - strip] + raw[pos:end]
+        pos = end + 1
+        index[path.decode(errors="surrogateescape")] = index_entry(
+            oid.hex(), mtime, ctime, size, ino, mode
+        )
+    return index
+
+
+def _serialize_index(index):
+    out = bytearray(struct.pack(">4sII", INDEX_SIGNATURE, INDEX_VERSION, len(index)))
+    previous = b""
+    for path, entry in sorted(index.items()):
+        path = path.encode(errors="surrogateescape")
+        common = len(os.path.commonprefix([previous, path]))
+        out += _index_entry_struct.pack(
+            entry.mtime,
+            entry.ctime,
+            entry.size,
+            entry.ino,
+            entry.mode,
+            bytes.fromhex(entry.oid),
+        )
+        out += _encode_varint(len(previous) - common)
+        out += path[common:] + b"\x00"
+        previous = path
+    out += hashlib.sha1(out).digest()
+    return out
+
+
+def _read_index():
+    if not os.path.isfile(f"{_git_dir()}/index"):
+        return {}
+    with open(f"{_git_dir()}/index", "rb") as f:
+        raw = f.read()
+
+    if not raw.startswith(b"{"):
+        return _parse_index(raw)
+
+    # Old JSON index, it's converted on the next write
+    index = {}
+    for path, entry in json.loads(raw).items():
+        # Old indexes only store the oid
+        if isinstance(entry, str):
+            entry = [entry]
+        index[path] = index_entry(*entry)
+    return index
+
+
+def _write_index(index, f):
+    _smudge_racy_entries(index, os.fstat(f.fileno()).st_mtime_ns)
+    f.write(_serialize_index(index))
 
 
 @contextmanager
 def get_index():
-    index = {}
-    if os.path.isfile(f"{GIT_DIR}/index"):
-        with open(f"{GIT_DIR}/index") as f:
-            index = json.load(f)
+    # The lock file is taken before the index is read and atomically replaces
+    # it once changed, so that concurrent commands can't lose each other's
+    # changes
+    git_dir = _git_dir()
+    lock_path = f"{git_dir}/index.lock"
+    try:
+        fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        fd = None
+    assert fd is not None, (
+        f"Unable to lock the index, {lock_path} exists. Another command may be "
+        "running, if not remove the file"
+    )
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            index = _read_index()
+            original = dict(index)
 
-    yield index
+            yield index
 
-    with open(f"{GIT_DIR}/index", "w") as f:
-        json.dump(index, f)
+            changed = index != original
+            if changed:
+                _write_index(index, f)
+    except BaseException:
+        os.remove(lock_path)
+        raise
+    if changed:
+        os.replace(lock_path, f"{git_dir}/index")
+    else:
+        os.remove(lock_path)
@@ -1,10 +1,12 @@
-import subprocess
-
-from collections import defaultdict
-from tempfile import NamedTemporaryFile as Temp
+from collections import defaultdict, namedtuple
 
 from . import data
 
+CONTEXT = 3
+# Only the start of the content is checked for NUL bytes, like diff and git do
+BINARY_CHECK_SIZE = 8000
+FUNCTION_WIDTH = 40
+
 
 def compare_trees(*trees):
     entries = defaultdict(lambda: [None] * len(trees))
@@ -16,42 +18,502 @@ def compare_trees(*trees):
         yield (path, *oids)
 
 
-def diff_trees(tree_from, tree_to):
-    output = b""
-    for path, object_from, object_to in compare_trees(tree_from, tree_to):
+# With working_tree=True, tree_to is a working tree, its blobs are read from
+# the files since they aren't stored as objects
+def diff_trees(tree_from, tree_to, working_tree=False):
+    yield from diff_changes(compare_trees(tree_from, tree_to), working_tree)
+
+
+# Changes are (path, object_from, object_to) tuples
+def diff_changes(changes, working_tree=False):
+    for path, object_from, object_to in changes:
         if object_from != object_to:
-            output += diff_blobs(object_from, object_to, path)
-    return output
-
-
-def diff_blobs(object_from, object_to, path="blob"):
-    with Temp() as file_from, Temp() as file_to:
-        for oid, f in ((object_from, file_from), (object_to, file_to)):
-            if oid:
-                f.write(data.get_object(oid))
-                f.flush()
-
-        with subprocess.Popen(
-            [
-                "diff",
-                "--unified",
-                "--show-c-function",
-                "--label",
-                f"a/{path}",
-                file_from.name,
-                "--label",
-                f"b/{path}",
-                file_to.name,
-            ],
-            stdout=subprocess.PIPE,
-        ) as proc:
-            output, _ = proc.communicate()
-
-        return output
+            yield from diff_blobs(object_from, object_to, path, working_tree)
+
+
+def diff_blobs(object_from, object_to, path="blob", working_tree=False):
+    content_from = data.get_object(object_from) if object_from else b""
+    content_to = b""
+    if object_to and working_tree:
+        with open(data.working_path(path), "rb") as f:
+            content_to = f.read()
+    elif object_to:
+        content_to = data.get_object(object_to)
+
+    yield from unified_diff(content_from, content_to, f"a/{path}", f"b/{path}")
+
+
+def is_binary(content):
+    return b"\x00" in content[:BINARY_CHECK_SIZE]
+
+
+def _split_lines(content):
+    lines = content.split(b"\n")
+    last = lines.pop()
+    lines = [line + b"\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+# Same output as `diff --unified --show-c-function`
+def unified_diff(content_from, content_to, label_from, label_to):
+    if content_from == content_to:
+        return
+
+    label_from = label_from.encode(errors="surrogateescape")
+    label_to = label_to.encode(errors="surrogateescape")
+    if is_binary(content_from) or is_binary(content_to):
+        yield b"Binary files %s and %s differ\n" % (label_from, label_to)
+        return
+
+    a = _split_lines(content_from)
+    b = _split_lines(content_to)
+    yield b"--- %s\n+++ %s\n" % (label_from, label_to)
+
+    find_function = _function_finder(a)
+    for hunk in _group_hunks(_get_opcodes(a, b)):
+        a_start, b_start = hunk[0][1], hunk[0][3]
+        a_end, b_end = hunk[-1][2], hunk[-1][4]
+        output = [
+            b"@@ -%s +%s @@%s\n"
+            % (
+                _format_range(a_start, a_end),
+                _format_range(b_start, b_end),
+                find_function(a_start),
+            )
+        ]
+        for tag, i1, i2, j1, j2 in hunk:
+            if tag == "equal":
+                output.extend(_format_lines(b" ", a[i1:i2]))
+                continue
+            output.extend(_format_lines(b"-", a[i1:i2]))
+            output.extend(_format_lines(b"+", b[j1:j2]))
+        yield b"".join(output)
+
+
+def _format_lines(prefix, lines):
+    for line in lines:
+        if line.endswith(b"\n"):
+            yield prefix + line
+        else:
+            yield prefix + line + b"\n\\ No newline at end of file\n"
+
+
+def _format_range(start, end):
+    length = end - start
+    if length == 0:
+        return b"%d,0" % start
+    if length == 1:
+        return b"%d" % (start + 1)
+    return b"%d,%d" % (start + 1, length)
+
+
+def _function_finder(lines):
+    # The function of a hunk is the last line before it that starts with a
+    # letter, `_` or `$`. Like diff, every search resumes where the previous
+    # one started
+    last_search = 0
+    last_match = b""
+
+    def find(start):
+        nonlocal last_search, last_match
+        for i in range(start - 1, last_search - 1, -1):
+            first = lines[i][:1]
+            if first.isalpha() or first in (b"_", b"$"):
+                last_match = b" " + lines[i][:FUNCTION_WIDTH].rstrip()
+                break
+        last_search = start
+        return last_match
+
+    return find
+
+
+def _group_hunks(opcodes):
+    # Changes separated by at most 2 * CONTEXT unchanged lines share a hunk
+    opcodes = list(opcodes)
+    if opcodes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = tag, max(i1, i2 - CONTEXT), i2, max(j1, j2 - CONTEXT), j2
+    if opcodes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = tag, i1, min(i2, i1 + CONTEXT), j1, min(j2, j1 + CONTEXT)
+
+    hunk = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal" and i2 - i1 > 2 * CONTEXT:
+            hunk.append((tag, i1, i1 + CONTEXT, j1, j1 + CONTEXT))
+            yield hunk
+            hunk = []
+            i1, j1 = i2 - CONTEXT, j2 - CONTEXT
+        hunk.append((tag, i1, i2, j1, j2))
+    if hunk and not (len(hunk) == 1 and hunk[0][0] == "equal"):
+        yield hunk
+
+
+def _get_opcodes(a, b, horizon=CONTEXT):
+    # Opcodes in the format of difflib: (tag, i1, i2, j1, j2)
+    # Lines are replaced by integer ids (from 1) so comparisons are cheap
+    ids = {}
+    a = [ids.setdefault(line, len(ids) + 1) for line in a]
+    b = [ids.setdefault(line, len(ids) + 1) for line in b]
+
+    # One flag per line, plus a trailing sentinel (also read at index -1)
+    changed_a = [False] * (len(a) + 1)
+    changed_b = [False] * (len(b) + 1)
+
+    # Like diff, the common prefix and suffix are skipped except for the
+    # horizon lines next to the changes
+    prefix = 0
+    while prefix < min(len(a), len(b)) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(a), len(b)) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    start = max(prefix - horizon, 0)
+    end = max(suffix - horizon, 0)
+
+    (a_lines, a_indexes), (b_lines, b_indexes) = _discard_confusing_lines(
+        a[start : len(a) - end], b[start : len(b) - end]
+    )
+    for lines, indexes, changed in (
+        (a, a_indexes, changed_a),
+        (b, b_indexes, changed_b),
+    ):
+        kept = set(indexes)
+        for i in range(len(lines) - start - end):
+            if i not in kept:
+                changed[start + i] = True
+
+    deleted, inserted = [], []
+    diagonals = len(a_lines) + len(b_lines) + 3
+    too_expensive = 1
+    while diagonals:
+        too_expensive <<= 1
+        diagonals >>= 2
+    context = _DiffContext(
+        a_lines,
+        b_lines,
+        [0] * (len(a_lines) + len(b_lines) + 3),
+        [0] * (len(a_lines) + len(b_lines) + 3),
+        len(b_lines) + 1,
+        max(4096, too_expensive),
+    )
+    _compareseq(context, 0, len(a_lines), 0, len(b_lines), False, deleted, inserted)
+    for i in deleted:
+        changed_a[start + a_indexes[i]] = True
+    for j in inserted:
+        changed_b[start + b_indexes[j]] = True
+
+    # Changes never slide into the skipped prefix and suffix
+    a_region, b_region = a[start : len(a) - end], b[start : len(b) - end]
+    region_a = changed_a[start : len(a) - end] + [False]
+    region_b = changed_b[start : len(b) - end] + [False]
+    _shift_boundaries(a_region, region_a, region_b)
+    _shift_boundaries(b_region, region_b, region_a)
+    changed_a[start : len(a) - end] = region_a[:-1]
+    changed_b[start : len(b) - end] = region_b[:-1]
+
+    i = j = 0
+    while i < len(a) or j < len(b):
+        if changed_a[i] or changed_b[j]:
+            i1, j1 = i, j
+            while changed_a[i]:
+                i += 1
+            while changed_b[j]:
+                j += 1
+            tag = "replace" if i > i1 and j > j1 else "delete" if i > i1 else "insert"
+            yield tag, i1, i, j1, j
+            continue
+
+        i1, j1 = i, j
+        while i < len(a) and not changed_a[i] and not changed_b[j]:
+            i += 1
+            j += 1
+        yield "equal", i1, i, j1, j
+
+
+def _discard_confusing_lines(a, b):
+    # Lines without any match in the other file are changed for sure and are
+    # left out of the search, as are runs of lines with very many matches.
+    # Returns the kept lines and their indexes for both files
+    counts = ({}, {})
+    for f, lines in enumerate((a, b)):
+        for line in lines:
+            counts[f][line] = counts[f].get(line, 0) + 1
+
+    result = []
+    for f, lines in enumerate((a, b)):
+        other_counts = counts[1 - f]
+        many = 5
+        tem = len(lines) // 64
+        while True:
+            tem >>= 2
+            if not tem:
+                break
+            many *= 2
+
+        discards = []
+        for line in lines:
+            matches = other_counts.get(line, 0)
+            discards.append(1 if not matches else 2 if matches > many else 0)
+
+        _cancel_provisional_discards(discards)
+        indexes = [i for i, discard in enumerate(discards) if not discard]
+        result.append(([lines[i] for i in indexes], indexes))
+    return result
+
+
+def _cancel_provisional_discards(discards):
+    # Provisional discards (2) are only kept inside runs of discards that
+    # start and end with definite discards (1)
+    end = len(discards)
+    i = 0
+    while i < end:
+        if discards[i] == 2:
+            discards[i] = 0
+        elif discards[i]:
+            provisional = 0
+            j = i
+            while j < end and discards[j]:
+                if discards[j] == 2:
+                    provisional += 1
+                j += 1
+            while j > i and discards[j - 1] == 2:
+                j -= 1
+                discards[j] = 0
+                provisional -= 1
+            length = j - i
+
+            if provisional * 4 > length:
+                for k in range(i, j):
+                    if discards[k] == 2:
+                        discards[k] = 0
+            else:
+                minimum = 1
+                tem = length >> 2
+                while True:
+                    tem >>= 2
+                    if not tem:
+                        break
+                    minimum <<= 1
+                minimum += 1
+
+                consec = 0
+                k = 0
+                while k < length:
+                    if discards[i + k] != 2:
+                        consec = 0
+                    else:
+                        consec += 1
+                        if consec == minimum:
+                            k -= consec
+                        elif consec > minimum:
+                            discards[i + k] = 0
+                    k += 1
+
+                for step in (1, -1):
+                    position = i if step == 1 else i + length - 1
+                    consec = 0
+                    for k in range(length):
+                        current = position + step * k
+                        if k >= 8 and discards[current] == 1:
+                            break
+                        if discards[current] == 2:
+                            consec = 0
+                            discards[current] = 0
+                        elif discards[current] == 0:
+                            consec = 0
+                        else:
+                            consec += 1
+                        if consec == 3:
+                            break
+                i += length - 1
+        i += 1
+
+
+_DiffContext = namedtuple(
+    "_DiffContext", ["a", "b", "forward", "backward", "offset", "too_expensive"]
+)
+
+
+def _compareseq(context, xoff, xlim, yoff, ylim, find_minimal, deleted, inserted):
+    a, b = context.a, context.b
+    while xoff < xlim and yoff < ylim and a[xoff] == b[yoff]:
+        xoff += 1
+        yoff += 1
+    while xlim > xoff and ylim > yoff and a[xlim - 1] == b[ylim - 1]:
+        xlim -= 1
+        ylim -= 1
+
+    if xoff == xlim:
+        inserted.extend(range(yoff, ylim))
+    elif yoff == ylim:
+        deleted.extend(range(xoff, xlim))
+    else:
+        xmid, ymid, lo_minimal, hi_minimal = _diag(
+            context, xoff, xlim, yoff, ylim, find_minimal
+        )
+        _compareseq(context, xoff, xmid, yoff, ymid, lo_minimal, deleted, inserted)
+        _compareseq(context, xmid, xlim, ymid, ylim, hi_minimal, deleted, inserted)
+
+
+def _diag(context, xoff, xlim, yoff, ylim, find_minimal):
+    # Find the midpoint of the shortest edit script with Myers' O(ND)
+    # algorithm, searching from both ends at once. Diagonals are x - y, the
+    # arrays are indexed by diagonal + offset
+    a, b = context.a, context.b
+    fd, bd, offset = context.forward, context.backward, context.offset
+    dmin, dmax = xoff - ylim, xlim - yoff
+    fmid, bmid = xoff - yoff, xlim - ylim
+    fmin = fmax = fmid
+    bmin = bmax = bmid
+    odd = (fmid - bmid) & 1
+    fd[fmid + offset] = xoff
+    bd[bmid + offset] = xlim
+    no_match = xlim + ylim + 1
+
+    c = 0
+    while True:
+        c += 1
+        if fmin > dmin:
+            fmin -= 1
+            fd[fmin - 1 + offset] = -1
+        else:
+            fmin += 1
+        if fmax < dmax:
+            fmax += 1
+            fd[fmax + 1 + offset] = -1
+        else:
+            fmax -= 1
+        for d in range(fmax, fmin - 1, -2):
+            tlo, thi = fd[d - 1 + offset], fd[d + 1 + offset]
+            x = thi if tlo < thi else tlo + 1
+            y = x - d
+            while x < xlim and y < ylim and a[x] == b[y]:
+                x += 1
+                y += 1
+            fd[d + offset] = x
+            if odd and bmin <= d <= bmax and bd[d + offset] <= x:
+                return x, y, True, True
+
+        if bmin > dmin:
+            bmin -= 1
+            bd[bmin - 1 + offset] = no_match
+        else:
+            bmin += 1
+        if bmax < dmax:
+            bmax += 1
+            bd[bmax + 1 + offset] = no_match
+        else:
+            bmax -= 1
+        for d in range(bmax, bmin - 1, -2):
+            tlo, thi = bd[d - 1 + offset], bd[d + 1 + offset]
+            x = tlo if tlo < thi else thi - 1
+            y = x - d
+            while xoff < x and yoff < y and a[x - 1] == b[y - 1]:
+                x -= 1
+                y -= 1
+            bd[d + offset] = x
+            if not odd and fmin <= d <= fmax and x <= fd[d + offset]:
+                return x, y, True, True
+
+        if find_minimal or c < context.too_expensive:
+            continue
+
+        # Too expensive: give up and split at the furthest point reached
+        fxybest = -1
+        for d in range(fmax, fmin - 1, -2):
+            x = min(fd[d + offset], xlim)
+            y = x - d
+            if ylim < y:
+                x, y = ylim + d, ylim
+            if fxybest < x + y:
+                fxybest, fxbest = x + y, x
+
+        bxybest = no_match * 2
+        for d in range(bmax, bmin - 1, -2):
+            x = max(xoff, bd[d + offset])
+            y = x - d
+            if y < yoff:
+                x, y = yoff + d, yoff
+            if x + y < bxybest:
+                bxybest, bxbest = x + y, x
+
+        if (xlim + ylim) - bxybest < fxybest - (xoff + yoff):
+            return fxbest, fxybest - fxbest, True, False
+        return bxbest, bxybest - bxbest, False, True
+
+
+def _shift_boundaries(lines, changed, other_changed):
+    # Slide runs of changed lines over identical neighbours, the same way diff
+    # does: merge with adjacent runs when possible, otherwise move the run as
+    # far down as possible
+    i = j = 0
+    end = len(lines)
+    while True:
+        while i < end and not changed[i]:
+            while other_changed[j]:
+                j += 1
+            j += 1
+            i += 1
+        if i == end:
+            break
+
+        start = i
+        i += 1
+        while changed[i]:
+            i += 1
+        while other_changed[j]:
+            j += 1
+
+        while True:
+            runlength = i - start
+
+            while start and lines[start - 1] == lines[i - 1]:
+                start -= 1
+                i -= 1
+                changed[start] = True
+                changed[i] = False
+                while changed[start - 1]:
+                    start -= 1
+                j -= 1
+                while other_changed[j]:
+                    j -= 1
+
+            corresponding = i if other_changed[j - 1] else end
+
+            while i != end and lines[start] == lines[i]:
+                changed[start] = False
+                changed[i] = True
+                start += 1
+                i += 1
+                while changed[i]:
+                    i += 1
+                j += 1
+                while other_changed[j]:
+                    j += 1
+                    corresponding = i
+
+            if runlength == i - start:
+                break
+
+        while corresponding < i:
+            start -= 1
+            i -= 1
+            changed[start] = True
+            changed[i] = False
+            j -= 1
+            while other_changed[j]:
+                j -= 1
 
 
 def iter_changed_files(tree_from, tree_to):
-    for path, object_from, object_to in compare_trees(tree_from, tree_to):
+    yield from iter_change_actions(compare_trees(tree_from, tree_to))
+
+
+def iter_change_actions(changes):
+    for path, object_from, object_to in changes:
         if object_from != object_to:
             action = (
                 "new file"
@@ -61,43 +523,108 @@ def iter_changed_files(tree_from, tree_to):
             yield path, action
 
 
+# Trivial cases are resolved on the object ids, only paths changed on both
+# sides have their content merged
 def merge_trees(tree_base, tree_HEAD, tree_other):
     tree = {}
-    for path, object_base, object_HEAD, object_other in compare_trees(
-        tree_base, tree_HEAD, tree_other
-    ):
-        tree[path] = merge_blobs(object_base, object_HEAD, object_other)
+    for path, oid, _ in merge_changes(compare_trees(tree_base, tree_HEAD, tree_other)):
+        # No oid means the path was deleted
+        if oid:
+            tree[path] = oid
     return tree
 
 
+# Changes are (path, object_base, object_HEAD, object_other) tuples, yields the
+# merged oid of each path and whether it has conflicts
+def merge_changes(changes):
+    for path, object_base, object_HEAD, object_other in changes:
+        conflicted = False
+        if object_HEAD == object_other or object_base == object_other:
+            oid = object_HEAD
+        elif object_base == object_HEAD:
+            oid = object_other
+        else:
+            content, conflicted = merge_blobs(object_base, object_HEAD, object_other)
+            oid = data.hash_object(content) if content is not None else None
+        yield path, oid, conflicted
+
+
+# Returns the merged content (None when the path is deleted) and whether it
+# has conflicts
 def merge_blobs(object_base, object_HEAD, object_other):
-    with Temp() as file_base, Temp() as file_HEAD, Temp() as file_other:
-        for oid, f in (
-            (object_base, file_base),
-            (object_HEAD, file_HEAD),
-            (object_other, file_other),
-        ):
-            if oid:
-                f.write(data.get_object(oid))
-                f.flush()
-
-        with subprocess.Popen(
-            [
-                "diff3",
-                "-m",
-                "-L",
-                "HEAD",
-                file_HEAD.name,
-                "-L",
-                "BASE",
-                file_base.name,
-                "-L",
-                "MERGE_HEAD",
-                file_other.name,
-            ],
-            stdout=subprocess.PIPE,
-        ) as proc:
-            output, _ = proc.communicate()
-            assert proc.returncode in (0, 1)
-
-        return output
+    base, HEAD, other = (
+        data.get_object(oid) if oid else b""
+        for oid in (object_base, object_HEAD, object_other)
+    )
+    # Binary conflicts can't be marked, HEAD's version is kept but the path is
+    # still a conflict. A path HEAD deleted stays deleted, it isn't an empty
+    # file
+    if is_binary(base) or is_binary(HEAD) or is_binary(other):
+        return (HEAD if object_HEAD else None), True
+    return merge_contents(base, HEAD, other)
+
+
+# Same output as `diff3 -m -L HEAD -L BASE -L MERGE_HEAD`, except that the same
+# change made on both sides isn't a conflict. Returns the merged content and
+# whether it has conflicts
+def merge_contents(base, HEAD, other):
+    base, HEAD, other = (_split_lines(content) for content in (base, HEAD, other))
+    sides = (HEAD, other)
+
+    # Changes of each side as (base start, base end, side start, side end),
+    # diffed from the side to the base with the horizon diff3 uses
+    changes = []
+    for side, lines in enumerate(sides):
+        for tag, i1, i2, j1, j2 in _get_opcodes(lines, base, horizon=100):
+            if tag != "equal":
+                changes.append((j1, j2, i1, i2, side))
+    changes.sort()
+
+    output = []
+    conflicted = False
+    position = 0
+    # Line offset of each side relative to the base, after the last change
+    offsets = [0, 0]
+    i = 0
+    while i < len(changes):
+        # Changes overlapping or touching each other form one block
+        block = [changes[i]]
+        high = changes[i][1]
+        i += 1
+        while i < len(changes) and changes[i][0] <= high:
+            block.append(changes[i])
+            high = max(high, changes[i][1])
+            i += 1
+        low = block[0][0]
+
+        versions = []
+        for side, lines in enumerate(sides):
+            side_changes = [change for change in block if change[4] == side]
+            if side_changes:
+                first, last = side_changes[0], side_changes[-1]
+                start = first[2] - (first[0] - low)
+                end = last[3] + (high - last[1])
+                offsets[side] = last[3] - last[1]
+            else:
+                start, end = low + offsets[side], high + offsets[side]
+            versions.append(lines[start:end])
+
+        output.extend(base[position:low])
+        position = high
+        changed = {change[4] for change in block}
+        if len(changed) == 1:
+            output.extend(versions[changed.pop()])
+        elif versions[0] == versions[1]:
+            output.extend(versions[0])
+        else:
+            conflicted = True
+            output.append(b"<<<<<<< HEAD\n")
+            output.extend(versions[0])
+            output.append(b"||||||| BASE\n")
+            output.extend(base[low:high])
+            output.append(b"=======\n")
+            output.extend(versions[1])
+            output.append(b">>>>>>> MERGE_HEAD\n")
+
+    output.extend(base[position:])
+    return b"".join(output), conflicted
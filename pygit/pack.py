@@ -0,0 +1,558 @@
+import os
+import hashlib
+import mmap
+import struct
+import threading
+import zlib
+
+from collections import OrderedDict
+
+TYPES = {"commit": 1, "tree": 2, "blob": 3}
+TYPE_NAMES = {number: name for name, number in TYPES.items()}
+OFS_DELTA = 6
+
+PACK_SIGNATURE = b"PACK"
+IDX_SIGNATURE = b"PIDX"
+VERSION = 1
+
+# Delta search parameters
+WINDOW = 10
+MAX_DEPTH = 50
+MAX_DELTA_SIZE = 16 * 1024 * 1024
+MIN_COPY = 16
+
+CHUNK_SIZE = 64 * 1024
+
+# Delta bases kept inflated, per pack. Bigger bases are inflated again when
+# needed rather than flushing the cache
+BASE_CACHE_SIZE = int(os.environ.get("PYGIT_DELTA_BASE_CACHE_SIZE", 16 * 1024 * 1024))
+MAX_BASE_SIZE = BASE_CACHE_SIZE // 16
+
+
+def _encode_size(size):
+    out = bytearray()
+    while True:
+        byte = size & 0x7F
+        size >>= 7
+        if size:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _decode_size(buf, pos):
+    size = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        size |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return size, pos
+
+
+def _encode_header(type_num, size):
+    byte = (type_num << 4) | (size & 0x0F)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(byte | 0x80)
+        byte = size & 0x7F
+        size >>= 7
+    out.append(byte)
+    return bytes(out)
+
+
+def _decode_header(buf, pos):
+    byte = buf[pos]
+    pos += 1
+    type_num = (byte >> 4) & 0x07
+    size = byte & 0x0F
+    shift = 4
+    while byte & 0x80:
+        byte = buf[pos]
+        pos += 1
+        size |= (byte & 0x7F) << shift
+        shift += 7
+    return type_num, size, pos
+
+
+def _encode_offset(offset):
+    out = bytearray([offset & 0x7F])
+    offset >>= 7
+    while offset:
+        offset -= 1
+        out.append(0x80 | (offset & 0x7F))
+        offset >>= 7
+    return bytes(reversed(out))
+
+
+def _decode_offset(buf, pos):
+    byte = buf[pos]
+    pos += 1
+    offset = byte & 0x7F
+    while byte & 0x80:
+        byte = buf[pos]
+        pos += 1
+        offset = ((offset + 1) << 7) | (byte & 0x7F)
+    return offset, pos
+
+
+def _iter_lines(content):
+    offset = 0
+    for line in content.splitlines(keepends=True):
+        yield offset, line
+        offset += len(line)
+
+
+def create_delta(base, target):
+    # Line based matching: every line of the target is looked up in the base,
+    # and matches are extended line by line into copy instructions
+    index = {}
+    for offset, line in _iter_lines(base):
+        index.setdefault(line, offset)
+
+    delta = bytearray(_encode_size(len(base)) + _encode_size(len(target)))
+    pending = bytearray()
+
+    def flush_insert():
+        for i in range(0, len(pending), 0x7F):
+            chunk = pending[i : i + 0x7F]
+            delta.append(len(chunk))
+            delta.extend(chunk)
+        pending.clear()
+
+    def emit_copy(offset, size):
+        while size:
+            length = min(size, 0xFFFFFF)
+            op = 0x80
+            args = bytearray()
+            for i in range(4):
+                byte = (offset >> (8 * i)) & 0xFF
+                if byte:
+                    op |= 1 << i
+                    args.append(byte)
+            for i in range(3):
+                byte = (length >> (8 * i)) & 0xFF
+                if byte:
+                    op |= 1 << (4 + i)
+                    args.append(byte)
+            delta.append(op)
+            delta.extend(args)
+            offset += length
+            size -= length
+
+    lines = target.splitlines(keepends=True)
+    i = 0
+    while i < len(lines):
+        start = index.get(lines[i])
+        if start is None:
+            pending.extend(lines[i])
+            i += 1
+            continue
+
+        end, j = start, i
+        while j < len(lines) and base[end : end + len(lines[j])] == lines[j]:
+            end += len(lines[j])
+            j += 1
+
+        if end - start < MIN_COPY:
+            pending.extend(lines[i])
+            i += 1
+            continue
+
+        flush_insert()
+        emit_copy(start, end - start)
+        i = j
+
+    flush_insert()
+    return bytes(delta)
+
+
+def apply_delta(base, delta):
+    base_size, pos = _decode_size(delta, 0)
+    assert base_size == len(base), "Delta base size mismatch"
+    target_size, pos = _decode_size(delta, pos)
+
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (1 << (4 + i)):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset : offset + (size or 0x10000)]
+        else:
+            assert op, "Invalid delta opcode"
+            out += delta[pos : pos + op]
+            pos += op
+
+    assert len(out) == target_size, "Delta target size mismatch"
+    return bytes(out)
+
+
+def iter_inflate(chunks):
+    # Decompresses a zlib stream given in chunks, at most CHUNK_SIZE bytes at a
+    # time so that highly compressed content is never inflated at once
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        while not decompressor.eof:
+            out = decompressor.decompress(chunk, CHUNK_SIZE)
+            chunk = decompressor.unconsumed_tail
+            if out:
+                yield out
+            elif not chunk:
+                break
+        if decompressor.eof:
+            return
+    assert False, "Truncated zlib stream"
+
+
+def _tmp_path(pack_dir):
+    return f"{pack_dir}/tmp_pack_{os.getpid()}_{threading.get_ident()}"
+
+
+def write_pack_stream(objects, read, out):
+    # objects: iterable of (oid, obj_type, size, name) tuples, name is a hint
+    # used to find good delta bases (usually the path of the blob). Contents
+    # are read with read(oid) one at a time, in pack order, only the delta
+    # window is held in memory. The pack is written to the binary file object
+    # out, returns the offsets of the objects and the checksum of the pack
+    objects = sorted(
+        {obj[0]: obj for obj in objects}.values(),
+        key=lambda obj: (TYPES[obj[1]], obj[3][::-1] if obj[3] else "", -obj[2]),
+    )
+
+    offsets = {}
+    depths = {}
+    window = []
+    checksum = hashlib.sha1()
+
+    def write(chunk):
+        checksum.update(chunk)
+        out.write(chunk)
+
+    write(PACK_SIGNATURE + struct.pack(">II", VERSION, len(objects)))
+    position = 12
+
+    for oid, obj_type, _, _ in objects:
+        content = read(oid)
+        type_num = TYPES[obj_type]
+        best = None
+        if len(content) <= MAX_DELTA_SIZE:
+            for base_oid, base_type, base_content in window:
+                if base_type != obj_type or depths[base_oid] >= MAX_DEPTH:
+                    continue
+                delta = create_delta(base_content, content)
+                if len(delta) < len(content) // 2 and (
+                    best is None or len(delta) < len(best[1])
+                ):
+                    best = (base_oid, delta)
+
+        offsets[oid] = position
+        if best:
+            base_oid, delta = best
+            depths[oid] = depths[base_oid] + 1
+            entry = _encode_header(OFS_DELTA, len(delta))
+            entry += _encode_offset(position - offsets[base_oid])
+            entry += zlib.compress(delta)
+        else:
+            depths[oid] = 0
+            entry = _encode_header(type_num, len(content))
+            entry += zlib.compress(content)
+        write(entry)
+        position += len(entry)
+
+        if len(content) <= MAX_DELTA_SIZE:
+            window.append((oid, obj_type, content))
+            del window[:-WINDOW]
+
+    pack_checksum = checksum.digest()
+    out.write(pack_checksum)
+    return offsets, pack_checksum
+
+
+def write_pack(objects, read, pack_dir):
+    os.makedirs(pack_dir, exist_ok=True)
+    tmp_path = _tmp_path(pack_dir)
+    with open(tmp_path, "wb") as out:
+        offsets, pack_checksum = write_pack_stream(objects, read, out)
+    return _store_pack(tmp_path, offsets, pack_checksum, pack_dir)
+
+
+def _store_pack(tmp_path, offsets, pack_checksum, pack_dir):
+    name = pack_checksum.hex()
+    os.replace(tmp_path, f"{pack_dir}/pack-{name}.pack")
+    _write_index(offsets, pack_checksum, f"{pack_dir}/pack-{name}.idx")
+    return name
+
+
+def index_pack(pack_path):
+    # Verifies a pack written by someone else and computes the object ids of
+    # its entries, returns the offsets of the objects and the pack checksum
+    pack_data = PackData(pack_path)
+    try:
+        buf = pack_data.pack
+        checksum = hashlib.sha1()
+        for start in range(0, len(buf) - 20, CHUNK_SIZE):
+            checksum.update(buf[start : min(start + CHUNK_SIZE, len(buf) - 20)])
+        pack_checksum = buf[-20:]
+        assert checksum.digest() == pack_checksum, "Pack checksum mismatch"
+
+        offsets = {}
+        for offset, obj_type, content in pack_data.iter_entries():
+            sha = hashlib.sha1(obj_type.encode() + b"\x00")
+            sha.update(content)
+            offsets[sha.hexdigest()] = offset
+        return offsets, pack_checksum
+    finally:
+        pack_data.close()
+
+
+def receive_pack(chunks, pack_dir):
+    # Stores a pack received as chunks of bytes, returns its name (None for a
+    # pack without objects)
+    os.makedirs(pack_dir, exist_ok=True)
+    tmp_path = _tmp_path(pack_dir)
+    try:
+        with open(tmp_path, "wb") as out:
+            for chunk in chunks:
+                out.write(chunk)
+        offsets, pack_checksum = index_pack(tmp_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if not offsets:
+        os.remove(tmp_path)
+        return None
+    return _store_pack(tmp_path, offsets, pack_checksum, pack_dir)
+
+
+def _write_index(offsets, pack_checksum, path):
+    oids = sorted(offsets)
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[int(oid[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    idx = bytearray(IDX_SIGNATURE + struct.pack(">I", VERSION))
+    idx += struct.pack(">256I", *fanout)
+    for oid in oids:
+        idx += bytes.fromhex(oid)
+    for oid in oids:
+        idx += struct.pack(">Q", offsets[oid])
+    idx += pack_checksum
+    idx += hashlib.sha1(idx).digest()
+
+    # The index is written last: a pack is only visible once its index exists
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(idx)
+    os.replace(tmp_path, path)
+
+
+class PackData:
+    # Reads the entries of a pack file, deltas are resolved through a cache of
+    # recently used delta bases, bounded by BASE_CACHE_SIZE bytes
+    def __init__(self, pack_path):
+        self.pack_path = pack_path
+        self._base_cache = OrderedDict()
+        self._base_cache_size = 0
+        self._lock = threading.Lock()
+
+        with open(pack_path, "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self.pack[:4] == PACK_SIGNATURE, f"Bad pack {pack_path}"
+        self.entry_count = struct.unpack_from(">I", self.pack, 8)[0]
+
+    def _iter_inflate(self, pos):
+        return iter_inflate(
+            self.pack[start : start + CHUNK_SIZE]
+            for start in range(pos, len(self.pack), CHUNK_SIZE)
+        )
+
+    def _inflate(self, pos, size):
+        # Returns the inflated data and the position right after it
+        decompressor = zlib.decompressobj()
+        out = bytearray()
+        while not decompressor.eof:
+            chunk = self.pack[pos : pos + CHUNK_SIZE]
+            assert chunk, "Truncated pack"
+            out += decompressor.decompress(chunk)
+            pos += len(chunk)
+        assert len(out) == size, "Corrupt pack entry"
+        return bytes(out), pos - len(decompressor.unused_data)
+
+    def _read_entry(self, offset):
+        # Returns the type and content of the entry at offset, and the offset
+        # of the next entry
+        type_num, size, pos = _decode_header(self.pack, offset)
+        if type_num == OFS_DELTA:
+            base_distance, pos = _decode_offset(self.pack, pos)
+            obj_type, base = self._read_base(offset - base_distance)
+            delta, end = self._inflate(pos, size)
+            return obj_type, apply_delta(base, delta), end
+        content, end = self._inflate(pos, size)
+        return TYPE_NAMES[type_num], content, end
+
+    def _cache(self, offset, entry):
+        size = len(entry[1])
+        if size > MAX_BASE_SIZE:
+            return
+        with self._lock:
+            if offset in self._base_cache:
+                return
+            self._base_cache[offset] = entry
+            self._base_cache_size += size
+            while self._base_cache_size > BASE_CACHE_SIZE:
+                _, evicted = self._base_cache.popitem(last=False)
+                self._base_cache_size -= len(evicted[1])
+
+    def _read_base(self, offset):
+        with self._lock:
+            entry = self._base_cache.get(offset)
+            if entry:
+                self._base_cache.move_to_end(offset)
+                return entry
+
+        obj_type, content, _ = self._read_entry(offset)
+        self._cache(offset, (obj_type, content))
+        return obj_type, content
+
+    def _read_at(self, offset):
+        obj_type, content, _ = self._read_entry(offset)
+        return obj_type, content
+
+    def read_header(self, offset):
+        # Type and size of the entry at offset, without inflating its content.
+        # The size of a delta is its target size, read from the delta header
+        type_num, size, pos = _decode_header(self.pack, offset)
+        if type_num != OFS_DELTA:
+            return TYPE_NAMES[type_num], size
+        base_distance, pos = _decode_offset(self.pack, pos)
+        obj_type, _ = self.read_header(offset - base_distance)
+        delta = b""
+        for chunk in self._iter_inflate(pos):
+            delta += chunk
+            if len(delta) >= 20:
+                break
+        _, pos = _decode_size(delta, 0)
+        target_size, _ = _decode_size(delta, pos)
+        return obj_type, target_size
+
+    def iter_entries(self):
+        # All entries in pack order, as (offset, obj_type, content). Entries
+        # are cached as possible delta bases of the ones that follow
+        offset = 12
+        for _ in range(self.entry_count):
+            obj_type, content, end = self._read_entry(offset)
+            self._cache(offset, (obj_type, content))
+            yield offset, obj_type, content
+            offset = end
+
+    def close(self):
+        self.pack.close()
+
+
+class Pack(PackData):
+    FANOUT_OFFSET = 8
+    OIDS_OFFSET = FANOUT_OFFSET + 256 * 4
+
+    def __init__(self, idx_path):
+        super().__init__(idx_path[: -len(".idx")] + ".pack")
+        self.idx_path = idx_path
+
+        with open(idx_path, "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self.idx[:4] == IDX_SIGNATURE, f"Bad pack index {idx_path}"
+        self.fanout = struct.unpack_from(">256I", self.idx, self.FANOUT_OFFSET)
+        self.count = self.fanout[255]
+        self.offsets_offset = self.OIDS_OFFSET + 20 * self.count
+
+    def _oid_at(self, i):
+        start = self.OIDS_OFFSET + 20 * i
+        return self.idx[start : start + 20]
+
+    def _lower_bound(self, raw):
+        # Binary search the sorted oids within the fanout bucket of the first
+        # byte, returns the position of the first oid not lower than raw
+        lo = self.fanout[raw[0] - 1] if raw[0] else 0
+        hi = self.fanout[raw[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._oid_at(mid) < raw:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, oid):
+        # Returns the offset of the object in the pack
+        raw = bytes.fromhex(oid)
+        i = self._lower_bound(raw)
+        if i < self.count and self._oid_at(i) == raw:
+            return struct.unpack_from(">Q", self.idx, self.offsets_offset + 8 * i)[0]
+        return None
+
+    def iter_prefix(self, prefix):
+        # Oids starting with the hex prefix (at least 2 characters), in order
+        raw = bytes.fromhex(prefix[: len(prefix) // 2 * 2])
+        for i in range(self._lower_bound(raw), self.count):
+            oid = self._oid_at(i)
+            if not oid.startswith(raw):
+                return
+            oid = oid.hex()
+            if oid.startswith(prefix):
+                yield oid
+
+    def __contains__(self, oid):
+        return self.find(oid) is not None
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._oid_at(i).hex()
+
+    def read(self, oid):
+        offset = self.find(oid)
+        if offset is None:
+            return None
+        return self._read_at(offset)
+
+    def header(self, oid):
+        offset = self.find(oid)
+        if offset is None:
+            return None
+        return self.read_header(offset)
+
+    def stream(self, oid):
+        # Returns the type of the object and an iterator over its content.
+        # Only undeltified objects (all the big ones) are streamed
+        offset = self.find(oid)
+        if offset is None:
+            return None
+        type_num, _, pos = _decode_header(self.pack, offset)
+        if type_num == OFS_DELTA:
+            obj_type, content = self._read_at(offset)
+            return obj_type, iter([content])
+        return TYPE_NAMES[type_num], self._iter_inflate(pos)
+
+    def close(self):
+        self.idx.close()
+        super().close()
+
+
+def iter_index_paths(pack_dir):
+    if not os.path.isdir(pack_dir):
+        return
+    for filename in sorted(os.listdir(pack_dir)):
+        if filename.startswith("pack-") and filename.endswith(".idx"):
+            yield f"{pack_dir}/{filename}"
@@ -0,0 +1,101 @@
+import socket
+
+# Packets are framed with their length (including the 4 bytes of the length)
+# as 4 hex digits, a "0000" flush packet ends a section
+FLUSH = b"0000"
+MAX_PAYLOAD = 65516
+
+DEFAULT_PORT = 9419
+DEFAULT_URL = f"pygit://localhost:{DEFAULT_PORT}"
+
+# Value of refs that don't exist
+ZERO_OID = "0" * 40
+TCP_PREFIX = "pygit://"
+UNIX_PREFIX = "unix://"
+
+
+def is_url(remote):
+    return remote.startswith((TCP_PREFIX, UNIX_PREFIX))
+
+
+def parse_url(url):
+    # Returns the socket family and address of a pygit:// or unix:// url
+    if url.startswith(UNIX_PREFIX):
+        return socket.AF_UNIX, url[len(UNIX_PREFIX) :]
+    host, _, port = url[len(TCP_PREFIX) :].rstrip("/").partition(":")
+    return socket.AF_INET, (host or "localhost", int(port or DEFAULT_PORT))
+
+
+def connect(url):
+    family, address = parse_url(url)
+    if family == socket.AF_UNIX:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        return sock
+    return socket.create_connection(address)
+
+
+def write_packet(out, payload):
+    assert len(payload) <= MAX_PAYLOAD, "Packet too long"
+    out.write(f"{len(payload) + 4:04x}".encode() + payload)
+
+
+def write_flush(out):
+    out.write(FLUSH)
+    out.flush()
+
+
+def read_packet(f):
+    # Returns the payload of the next packet, None for a flush packet. EOFError
+    # is raised when the stream ends between packets
+    header = f.read(4)
+    if not header:
+        raise EOFError
+    assert len(header) == 4, "Truncated packet"
+    length = int(header, 16)
+    if not length:
+        return None
+    assert length > 4, f"Bad packet length {length}"
+    payload = f.read(length - 4)
+    assert len(payload) == length - 4, "Truncated packet"
+    return payload
+
+
+def iter_packets(f):
+    # Payloads up to the next flush packet
+    while True:
+        payload = read_packet(f)
+        if payload is None:
+            return
+        yield payload
+
+
+def write_lines(out, lines):
+    for line in lines:
+        write_packet(out, f"{line}\n".encode())
+    write_flush(out)
+
+
+def read_lines(f):
+    return [payload.decode().rstrip("\n") for payload in iter_packets(f)]
+
+
+def write_status(out, error=None, lines=()):
+    # Responses start with a section whose first line is "ok" or "error <msg>"
+    write_lines(out, [f"error {error}" if error else "ok", *lines])
+
+
+def read_status(f):
+    status, *lines = read_lines(f)
+    assert status == "ok", status[len("error ") :]
+    return lines
+
+
+class PacketWriter:
+    # File-like object writing data packets, for streaming packs
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, data):
+        for start in range(0, len(data), MAX_PAYLOAD):
+            write_packet(self.out, data[start : start + MAX_PAYLOAD])
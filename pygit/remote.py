@@ -1,21 +1,155 @@
 import os
+import socket
+import sys
+import threading
+import time
 
 from . import data
 from . import base
+from . import protocol
 
 REMOTE_REFS_BASE = "refs/heads"
 LOCAL_REFS_BASE = "refs/remote"
 
+# Objects copied at once by path based fetches
+TRANSFER_WORKERS = int(os.environ.get("PYGIT_TRANSFER_WORKERS", 8))
 
-def fetch(remote_path):
+# Open connections to daemons, by url, reused across fetches and pushes
+_connections = {}
+
+
+class _Connection:
+    def __init__(self, url):
+        self.sock = protocol.connect(url)
+        self.rfile = self.sock.makefile("rb")
+        self.wfile = self.sock.makefile("wb")
+
+    def ls_refs(self, prefix=""):
+        protocol.write_lines(self.wfile, [f"ls-refs {prefix}".rstrip()])
+        refs = {}
+        for line in protocol.read_status(self.rfile):
+            oid, refname = line.split(" ", 1)
+            refs[refname] = oid
+        return refs
+
+    def fetch(self, wants, haves):
+        lines = ["fetch"]
+        lines.extend(f"want {oid}" for oid in wants)
+        lines.extend(f"have {oid}" for oid in haves if oid)
+        protocol.write_lines(self.wfile, lines)
+        protocol.read_status(self.rfile)
+        return data.receive_pack(protocol.iter_packets(self.rfile))
+
+    def push(self, refname, old, new, oids):
+        old = old or protocol.ZERO_OID
+        protocol.write_lines(self.wfile, [f"push {refname} {old} {new}"])
+        data.write_pack_stream(oids, protocol.PacketWriter(self.wfile))
+        protocol.write_flush(self.wfile)
+        protocol.read_status(self.rfile)
+
+    def is_closed(self):
+        # Whether the server closed the connection: it reads EOF, while an
+        # idle open connection has nothing to read
+        try:
+            return not self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+
+def _connect(url):
+    # Connections dropped by the server since the last command (daemon
+    # restarted, command failed midway) are established again
+    connection = _connections.get(url)
+    if connection and connection.is_closed():
+        connection.close()
+        connection = None
+    if not connection:
+        connection = _connections[url] = _Connection(url)
+    return connection
+
+
+def close_connections():
+    for connection in _connections.values():
+        connection.close()
+    _connections.clear()
+
+
+class _Progress:
+    # Counts transferred objects and bytes, reported on stderr
+    def __init__(self, title):
+        self.title = title
+        self.objects = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self._reported = self.start
+        self._lock = threading.Lock()
+
+    def _status(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return (
+            f"{self.title}: {self.objects} objects, {self.bytes / 1024:.1f} KiB "
+            f"in {elapsed:.2f}s ({self.objects / elapsed:.0f} objects/s, "
+            f"{self.bytes / 1024 / elapsed:.1f} KiB/s)"
+        )
+
+    def update(self, size):
+        if not size:
+            return
+        with self._lock:
+            self.objects += 1
+            self.bytes += size
+            now = time.monotonic()
+            if sys.stderr.isatty() and now - self._reported >= 0.5:
+                self._reported = now
+                print(f"\r{self._status()}", end="", file=sys.stderr, flush=True)
+
+    def done(self):
+        print(f"\r{self._status()}, done", file=sys.stderr)
+
+
+def _fetch_objects(objects, remote_path, workers):
+    # Blobs are copied on a pool of workers. Commits and trees are copied right
+    # away, the walk reads them as soon as they are yielded
+    progress = _Progress("Fetching objects")
+
+    def fetch_object(oid):
+        progress.update(data.fetch_object_if_missing(oid, remote_path))
+
+    with data.thread_pool(workers) as executor:
+        pending = []
+        for oid, obj_type in objects:
+            if obj_type == "blob":
+                pending.append(executor.submit(fetch_object, oid))
+            else:
+                fetch_object(oid)
+        for future in pending:
+            future.result()
+    progress.done()
+
+
+def fetch(remote_path, workers=TRANSFER_WORKERS):
     # Get refs from server
     refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
 
-    # Fetch missing objects by iterating and fetching on demand
-    for oid in base.iter_objects_in_commits(refs.values()):
-        data.fetch_object_if_missing(oid, remote_path)
+    # Fetch the objects that aren't reachable from local refs, by iterating
+    # and fetching on demand
+    local_refs = [ref.value for _, ref in data.iter_refs()]
+    if protocol.is_url(remote_path):
+        # The daemon does the walk and sends the objects as a pack
+        _connect(remote_path).fetch(refs.values(), local_refs)
+    else:
+        objects = base.iter_new_objects(refs.values(), local_refs)
+        _fetch_objects(objects, remote_path, workers)
+    base.write_commit_graph(refs.values())
 
-    # Update local refs to match server
+    # Update local refs to match server, once all objects are there
     for remote_name, value in refs.items():
         refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
         data.update_ref(
@@ -24,7 +158,12 @@ def fetch(remote_path):
 
 
 def _get_remote_refs(remote_path, prefix=""):
+    if protocol.is_url(remote_path):
+        return _connect(remote_path).ls_refs(prefix)
+    # The refs of another repository are never served from its snapshot, they
+    # may have been changed since it was read
     with data.change_git_dir(remote_path):
+        data.invalidate_refs()
         return {refname: ref.value for refname, ref in data.iter_refs(prefix)}
 
 
@@ -38,18 +177,22 @@ def push(remote_path, refname):
     # Don't allow force push
     assert not remote_ref or base.is_ancestor_of(local_ref, remote_ref)
 
-    # Compute which objects the server doesn't have
-    known_remote_refs = filter(data.object_exists, remote_refs.values())
-    remote_objects = set(base.iter_objects_in_commits(known_remote_refs))
-    local_objects = set(base.iter_objects_in_commits({local_ref}))
-    objects_to_push = local_objects - remote_objects
-
-    objects_to_push = base.iter_objects_in_commits({local_ref})
-
-    # Push missing objects
-    for oid in objects_to_push:
-        data.push_object(oid, remote_path)
+    # Push the objects the server doesn't have, the remote refs we know of
+    # stop the walk
+    objects_to_push = (
+        oid for oid, _ in base.iter_new_objects({local_ref}, remote_refs.values())
+    )
+    if protocol.is_url(remote_path):
+        # The daemon checks and updates the ref itself
+        _connect(remote_path).push(refname, remote_ref, local_ref, objects_to_push)
+        return
+    data.push_objects(objects_to_push, remote_path)
 
-    # Update server ref to our value
+    # Update server ref to our value, unless it moved while the objects were
+    # pushed
     with data.change_git_dir(remote_path):
+        data.invalidate_refs()
+        current = data.get_ref(refname).value
+        assert current == remote_ref, f"{refname} changed, fetch first"
+        base.write_commit_graph({local_ref})
         data.update_ref(refname, data.ref_value(symbolic=False, value=local_ref))
@@ -0,0 +1,190 @@
+import functools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from . import base
+from . import data
+from . import diff
+from . import pack
+from . import remote
+
+# Tracing is off unless enabled, functions are only wrapped then so that it
+# costs nothing otherwise. The output is a summary table on stderr, or a Chrome
+# trace (chrome://tracing, Perfetto) when it is the path of a .json file
+ENV_VAR = "PYGIT_TRACE"
+
+_lock = threading.Lock()
+_output = None
+_start = None
+# {name: [calls, seconds, bytes]}
+_stats = {}
+# Chrome trace events, only kept when writing a trace file
+_events = []
+
+
+def _result_size(args, kwargs, result):
+    return len(result)
+
+
+def _written_size(args, kwargs, result):
+    # Objects that are only hashed aren't counted
+    write = args[2] if len(args) > 2 else kwargs.get("write", True)
+    return len(args[0]) if write else None
+
+
+def _object_size(args, kwargs, result):
+    return len(result[1])
+
+
+# Sizes of the files written to a temporary path, before they are stored
+def _loose_object_size(args, kwargs):
+    return os.path.getsize(args[1])
+
+
+def _pack_size(args, kwargs):
+    return os.path.getsize(args[0])
+
+
+# module, function, bytes of a call from its arguments and result, bytes of a
+# call from its arguments before the call
+_TRACED = [
+    # Objects
+    (data, "get_object", _result_size, None),
+    (data, "_read_object_uncached", _object_size, None),
+    (data, "hash_object", _written_size, None),
+    (data, "hash_stream", None, None),
+    (data, "_store_loose_object", None, _loose_object_size),
+    (pack, "_store_pack", None, _pack_size),
+    (data, "object_exists", None, None),
+    # Refs and index
+    (data, "_read_refs", None, None),
+    (data, "_read_packed_refs", None, None),
+    (data, "update_ref", None, None),
+    (data, "_read_index", None, None),
+    (data, "_write_index", None, None),
+    # Phases of commands
+    (base, "add", None, None),
+    (base, "commit", None, None),
+    (base, "write_tree", None, None),
+    (base, "read_tree", None, None),
+    (base, "read_tree_merged", None, None),
+    (base, "_checkout_index", None, None),
+    (base, "get_working_tree", None, None),
+    (base, "get_index_tree", None, None),
+    (base, "get_merge_bases", None, None),
+    (base, "write_commit_graph", None, None),
+    (base, "repack", None, None),
+    (base, "gc", None, None),
+    (diff, "diff_blobs", None, None),
+    (diff, "merge_blobs", None, None),
+    (data, "pack_objects", None, None),
+    (data, "receive_pack", None, None),
+    (data, "push_objects", None, None),
+    (remote, "_get_remote_refs", None, None),
+    (remote, "_fetch_objects", None, None),
+]
+
+
+def _record(name, start, end, size):
+    with _lock:
+        stats = _stats.setdefault(name, [0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += end - start
+        stats[2] += size or 0
+        if _output != "-":
+            _events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - _start) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {"bytes": size} if size else {},
+                }
+            )
+
+
+def traced(name, func, size=None, size_before=None):
+    # Returns func timed under name, func itself when tracing is off
+    if _output is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        before = size_before(args, kwargs) if size_before else None
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            _record(name, start, time.perf_counter(), before)
+            raise
+        end = time.perf_counter()
+        _record(name, start, end, before or (size and size(args, kwargs, result)))
+        return result
+
+    return wrapper
+
+
+class _Popen(subprocess.Popen):
+    # Subprocess spawns are counted, the time is the one of the whole process
+    def __init__(self, args, *other_args, **kwargs):
+        self._trace_start = time.perf_counter()
+        self._trace_name = f"subprocess {os.path.basename(str(args[0]))}"
+        super().__init__(args, *other_args, **kwargs)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if self._trace_start is not None:
+            _record(self._trace_name, self._trace_start, time.perf_counter(), None)
+            self._trace_start = None
+        return returncode
+
+
+def enable(output):
+    # output: "-" (or any value that isn't a .json path) for the summary table,
+    # the path of a Chrome trace file otherwise
+    global _output, _start
+    if not output or output == "0" or _output is not None:
+        return
+    _output = output if output.endswith(".json") else "-"
+    _start = time.perf_counter()
+    for module, name, size, size_before in _TRACED:
+        func = getattr(module, name)
+        label = f"{module.__name__.split('.')[-1]}.{name}"
+        setattr(module, name, traced(label, func, size, size_before))
+    subprocess.Popen = _Popen
+
+
+def report():
+    if _output is None:
+        return
+    if _output == "-":
+        _print_summary()
+        return
+    with _lock:
+        trace = {"traceEvents": list(_events), "displayTimeUnit": "ms"}
+    with open(_output, "w") as f:
+        json.dump(trace, f)
+    print(f"Trace written to {_output}", file=sys.stderr)
+
+
+def _print_summary():
+    with _lock:
+        stats = sorted(_stats.items(), key=lambda item: item[1][1], reverse=True)
+    total = time.perf_counter() - _start
+    print(
+        f"\n{'name':<32} {'calls':>8} {'total ms':>10} {'mean us':>10} {'bytes':>12}",
+        file=sys.stderr,
+    )
+    for name, (calls, seconds, size) in stats:
+        print(
+            f"{name:<32} {calls:>8} {seconds * 1000:>10.2f} "
+            f"{seconds / calls * 1e6:>10.1f} {size or '':>12}",
+            file=sys.stderr,
+        )
+    print(f"{'total':<32} {'':>8} {total * 1000:>10.2f}", file=sys.stderr)